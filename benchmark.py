@@ -0,0 +1,386 @@
+"""Benchmark ingest điểm / import user, chạy offline hoàn toàn.
+
+- Sinh file Excel giả lập phiếu điểm VnEdu (khối "Mã HS", header "Môn học", cột TX/GK/CK/TB,
+  dòng đánh giá cả năm) với số học sinh tùy chọn.
+- MemoryFirestore: Firestore trong RAM, đếm lượt đọc / ghi / commit như cách Firestore tính tiền.
+- Mỗi giai đoạn báo thời gian, dòng/giây, bộ nhớ đỉnh (tracemalloc) và số lệnh Firestore.
+
+    python benchmark.py --sizes 100 1000 10000 --save bench.json
+    python benchmark.py --sizes 1000 --baseline bench.json      # exit 1 nếu có hồi quy
+"""
+import argparse
+import copy
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import openpyxl
+import pandas as pd
+
+# ==========================================
+# 1. SINH FILE ĐIỂM GIẢ LẬP
+# ==========================================
+SUBJECTS = ["Toán", "Ngữ văn", "Tiếng Anh", "Vật lí", "Hóa học", "Sinh học", "Lịch sử", "Địa lí",
+            "GDKT&PL", "Tin học", "Công nghệ", "Giáo dục thể chất", "GDQP-AN", "Hoạt động trải nghiệm"]
+# Môn đánh giá bằng nhận xét (Đ / CĐ) thay vì điểm số
+COMMENT_SUBJECTS = {"Giáo dục thể chất", "Hoạt động trải nghiệm"}
+TITLES = {"HK1": "HỌC KỲ 1", "HK2": "HỌC KỲ 2", "CaNam": "CẢ NĂM"}
+WIDTH = 9
+
+def student_code(i):
+    return str(2300000 + i)
+
+def make_users(n, nam_hoc="2023-2024"):
+    """Danh sách user khớp với file điểm: [(cccd, ma_hs, ho_ten, nien_khoa), ...] (khối 10)."""
+    start = int(nam_hoc.split('-')[0])
+    return [(f"0{i:011d}", student_code(i), f"Học Sinh {i}", f"{start}-{start + 3}") for i in range(n)]
+
+def make_score_rows(n, hoc_ky="HK1", nam_hoc="2023-2024", seed=0):
+    """Sinh các dòng của 1 sheet điểm (list các list, dài WIDTH), ~20 dòng / học sinh."""
+    rnd = random.Random(seed)
+    pad = lambda row: row + [None] * (WIDTH - len(row))
+    score = lambda: round(rnd.uniform(3.5, 10), 1)
+    rows = [pad(["SỞ GIÁO DỤC VÀ ĐÀO TẠO"]),
+            pad([None, None, f"PHIẾU BÁO ĐIỂM {TITLES[hoc_ky]} NĂM HỌC {nam_hoc.replace('-', ' - ')}"]),
+            pad([])]
+    for i in range(n):
+        rows.append(pad(["Họ và tên:", f"Học Sinh {i}", None, "Mã HS", student_code(i), None, "Lớp:", f"10A{i % 12 + 1}"]))
+        rows.append(pad(["Ngày sinh:", f"{rnd.randint(1, 28):02d}/{rnd.randint(1, 12):02d}/{int(nam_hoc[:4]) - 15}"]))
+        if hoc_ky == "CaNam": rows.append(pad(["STT", "Môn học", "ĐTB HK1", "ĐTB HK2", "TB Cả năm"]))
+        else: rows.append(pad(["STT", "Môn học", "ĐĐGtx (TX)", "ĐĐGgk (GK)", "ĐĐGck (CK)", "ĐTBmhk (TB)"]))
+        for j, mon in enumerate(SUBJECTS, 1):
+            if mon in COMMENT_SUBJECTS:
+                mark = rnd.choice(["Đ"] * 9 + ["CĐ"])
+                rows.append(pad([j, mon, mark, mark, mark] + ([] if hoc_ky == "CaNam" else [mark])))
+            elif hoc_ky == "CaNam":
+                rows.append(pad([j, mon, score(), score(), score()]))
+            else:
+                tx = " ".join(str(score()) for _ in range(rnd.randint(2, 4)))
+                rows.append(pad([j, mon, tx, score(), score(), score()]))
+        rows.append(pad([None, "Kết quả học tập"]))
+        if hoc_ky == "CaNam":
+            rows.append(pad([None, f"KQHT: {rnd.choice(['Tốt', 'Khá', 'Đạt'])}", None,
+                             f"KQRL: {rnd.choice(['Tốt', 'Khá'])}", None,
+                             f"Danh hiệu: {rnd.choice(['Học sinh Xuất sắc', 'Học sinh Giỏi', ''])}"]))
+            rows.append(pad([None, f"Nhận xét: Chăm ngoan, tiến bộ ({i})"]))
+        rows.append(pad([]))
+    return rows
+
+def workbook_bytes(sheets):
+    """sheets: {tên sheet: rows} -> bytes .xlsx (ghi write-only, không giữ cả workbook trong RAM)."""
+    wb = openpyxl.Workbook(write_only=True)
+    for title, rows in sheets.items():
+        ws = wb.create_sheet(title)
+        for row in rows: ws.append(row)
+    out = io.BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+def user_workbook_bytes(users):
+    df = pd.DataFrame(users, columns=["CCCD", "Ma_HS", "Ho_Ten", "Nien_Khoa"])
+    out = io.BytesIO()
+    df.to_excel(out, index=False)
+    return out.getvalue()
+
+# ==========================================
+# 2. FIRESTORE TRONG RAM
+# ==========================================
+# Đủ API mà streamlit_app dùng: document get/set/update, where / select / order_by /
+# start_after / limit / stream, batch, transaction (chạy được với firestore.transactional).
+# Tính lượt đọc giống Firestore: 1 / document trả về, query rỗng vẫn tính 1.
+_OPS = {'==': lambda a, b: a == b, '>=': lambda a, b: a >= b, '>': lambda a, b: a > b,
+        '<': lambda a, b: a < b, '<=': lambda a, b: a <= b}
+
+def _deep_merge(target, data):
+    for k, v in data.items():
+        if isinstance(v, dict) and isinstance(target.get(k), dict): _deep_merge(target[k], v)
+        else: target[k] = copy.deepcopy(v)
+
+class _Snapshot:
+    def __init__(self, ref, data):
+        self.reference, self.id, self._data = ref, ref.id, data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return self._data.get(field)
+
+class _DocRef:
+    def __init__(self, db, collection, doc_id):
+        self._db, self._collection, self.id = db, collection, doc_id
+
+    def get(self, transaction=None):
+        self._db.count(reads=1)
+        return _Snapshot(self, self._db.data[self._collection].get(self.id))
+
+    def set(self, data, merge=False):
+        self._db.count(writes=1)
+        docs = self._db.data[self._collection]
+        if merge and self.id in docs: _deep_merge(docs[self.id], data)
+        else: docs[self.id] = copy.deepcopy(data)
+
+    def update(self, data):
+        self._db.count(writes=1)
+        docs = self._db.data[self._collection]
+        if self.id not in docs: raise KeyError(f"{self._collection}/{self.id} không tồn tại")
+        docs[self.id].update(copy.deepcopy(data))
+
+    def delete(self):
+        self._db.count(writes=1)
+        self._db.data[self._collection].pop(self.id, None)
+
+class _Query:
+    def __init__(self, db, collection, filters=(), fields=None, order=None, after=None, limit=None):
+        self._db, self._collection = db, collection
+        self._filters, self._fields, self._order, self._after, self._limit = list(filters), fields, order, after, limit
+
+    def _with(self, **kwargs):
+        state = dict(filters=self._filters, fields=self._fields, order=self._order, after=self._after, limit=self._limit)
+        state.update(kwargs)
+        return _Query(self._db, self._collection, **state)
+
+    def where(self, field, op, value): return self._with(filters=self._filters + [(field, _OPS[op], value)])
+    def select(self, fields): return self._with(fields=list(fields))
+    def order_by(self, field): return self._with(order=field)
+    def start_after(self, snapshot): return self._with(after=snapshot)
+    def limit(self, n): return self._with(limit=n)
+
+    def _key(self, doc_id, data):
+        return doc_id if self._order in (None, '__name__') else (data.get(self._order), doc_id)
+
+    def stream(self):
+        docs = self._db.data[self._collection]
+        hits = [(doc_id, data) for doc_id, data in list(docs.items())
+                if all(field in data and data[field] is not None and op(data[field], value)
+                       for field, op, value in self._filters)]
+        if self._order is not None:
+            hits.sort(key=lambda kv: self._key(*kv))
+            if self._after is not None:
+                after = self._key(self._after.id, docs.get(self._after.id) or {})
+                hits = [kv for kv in hits if self._key(*kv) > after]
+        if self._limit is not None: hits = hits[:self._limit]
+        self._db.count(reads=max(len(hits), 1))
+        for doc_id, data in hits:
+            if self._fields is not None: data = {f: data[f] for f in self._fields if f in data}
+            yield _Snapshot(_DocRef(self._db, self._collection, doc_id), data)
+
+    def get(self): return list(self.stream())
+
+class _Collection(_Query):
+    def __init__(self, db, collection):
+        super().__init__(db, collection)
+
+    def document(self, doc_id=None):
+        if doc_id is None: doc_id = f"auto{next(self._db.auto_ids):08d}"
+        return _DocRef(self._db, self._collection, doc_id)
+
+class _Batch:
+    def __init__(self, db):
+        self._db, self._ops = db, []
+
+    def set(self, ref, data, merge=False): self._ops.append((ref.set, (data, merge)))
+    def update(self, ref, data): self._ops.append((ref.update, (data,)))
+    def delete(self, ref): self._ops.append((ref.delete, ()))
+
+    def commit(self):
+        if len(self._ops) > 500: raise ValueError("Batch vượt quá 500 lệnh ghi")
+        self._db.count(commits=1)
+        for fn, args in self._ops: fn(*args)
+        self._ops = []
+
+class _Transaction(_Batch):
+    # Giao thức mà firestore.transactional gọi tới
+    _read_only, _max_attempts, _id = False, 5, None
+    def _clean_up(self): self._ops = []
+    def _begin(self, retry_id=None): self._id = b"memory"
+    def _commit(self): self.commit()
+    def _rollback(self): self._ops = []
+
+class MemoryFirestore:
+    def __init__(self):
+        self.data = {}
+        self.reads = self.writes = self.commits = 0
+        self.auto_ids = iter(range(10 ** 9))
+        self._lock = threading.Lock() # loadtest.py gọi từ nhiều thread
+
+    def collection(self, name):
+        self.data.setdefault(name, {})
+        return _Collection(self, name)
+
+    def batch(self): return _Batch(self)
+    def transaction(self): return _Transaction(self)
+
+    def count(self, reads=0, writes=0, commits=0):
+        with self._lock:
+            self.reads += reads; self.writes += writes; self.commits += commits
+
+    def counters(self):
+        return {'reads': self.reads, 'writes': self.writes, 'commits': self.commits}
+
+# ==========================================
+# 3. NẠP APP VỚI FIRESTORE GIẢ
+# ==========================================
+def load_app():
+    """Import streamlit_app mà không cần secrets / mạng: firestore.client() trả về MemoryFirestore."""
+    os.environ.pop('DATABASE_URL', None)
+    # Cache bố cục riêng cho mỗi lần chạy: kết quả không phụ thuộc các lần chạy trước
+    os.environ['LAYOUT_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(), 'layouts.json')
+    import google.auth.credentials
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    class _OfflineCredential(credentials.Base):
+        def get_credential(self): return google.auth.credentials.AnonymousCredentials()
+
+    if not firebase_admin._apps: firebase_admin.initialize_app(_OfflineCredential(), {'projectId': 'benchmark'})
+    firestore.client = lambda app=None: MemoryFirestore()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import streamlit_app as app
+    # Chạy ngoài `streamlit run`: bỏ cảnh báo thiếu ScriptRunContext (filter vì streamlit tự đặt lại log level khi đọc config)
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(lambda r: "ScriptRunContext" not in r.getMessage())
+    return app
+
+def use_db(app, db):
+    app.store = app.FirestoreStore(db)
+    return db
+
+# ==========================================
+# 4. CÁC GIAI ĐOẠN ĐO
+# ==========================================
+# Mỗi giai đoạn = setup() -> (hàm cần đo, db, số dòng xử lý); setup chạy lại cho lượt đo bộ nhớ.
+# upload_job parse trong process pool (spawn) nên bộ nhớ đỉnh chỉ tính phần của process chính.
+def stages(app, n, hoc_ky, nam_hoc="2023-2024"):
+    from parsing import get_layout # Sau load_app: LAYOUT_CACHE_PATH đã trỏ vào cache riêng của lần chạy
+    rows = make_score_rows(n, hoc_ky, nam_hoc)
+    df = pd.DataFrame(rows, dtype=object)
+    data = workbook_bytes({"Sheet1": rows})
+    users = make_users(n, nam_hoc)
+    user_df = pd.read_excel(io.BytesIO(user_workbook_bytes(users)))
+
+    def learned():
+        # Bố cục đã nằm trong cache (file cùng mẫu đã upload trước đó); dò + lưu ở setup, ngoài phần đo
+        key = app.layout_fingerprint(df, hoc_ky)
+        if get_layout(key) is None: app.parse_score_sheet(df, hoc_ky, layout_key=key)
+        return key
+
+    def with_users():
+        db = use_db(app, MemoryFirestore())
+        app.bulk_import_users(users)
+        db.reads = db.writes = db.commits = 0
+        return db
+
+    def uploaded():
+        db = with_users()
+        app.process_upload_auto(df)
+        db.reads = db.writes = db.commits = 0
+        return db
+
+    def job():
+        app.start_upload_job([("bench.xlsx", data)], incremental=True)
+        while app.list_upload_jobs()[0]['finished_at'] is None: time.sleep(0.01)
+        result = list(app.list_upload_jobs()[0]['files'].values())[0]
+        if not result['ok']: raise RuntimeError(result['message'])
+
+    return {
+        'detect_file_info': lambda: (lambda: app.detect_file_info(df), None, len(rows)),
+        'parse_score_sheet': lambda: (lambda: app.parse_score_sheet(df, hoc_ky), None, len(rows)),
+        'parse_score_sheet_layout': lambda: (lambda key=learned(): app.parse_score_sheet(df, hoc_ky, layout_key=key), None, len(rows)),
+        'parse_score_file': lambda: (lambda: app.parse_score_file("bench.xlsx", data), None, len(rows)),
+        'parse_user_sheet': lambda: (lambda: app.parse_user_sheet(user_df), None, n),
+        'import_users': lambda: (lambda: app.bulk_import_users(users), use_db(app, MemoryFirestore()), n),
+        'import_users_again': lambda: (lambda: app.bulk_import_users(users), with_users(), n),
+        'upload': lambda: (lambda: app.process_upload_auto(df), with_users(), len(rows)),
+        'upload_incremental': lambda: (lambda: app.process_upload_auto(df, incremental=True), uploaded(), len(rows)),
+        'upload_job': lambda: (job, with_users(), len(rows)),
+    }
+
+def run_stage(setup, memory=True, repeat=3):
+    # Lấy lượt nhanh nhất trong `repeat` lượt để giảm nhiễu (lượt đầu còn tính cả warm-up cache)
+    best = counters = None
+    for _ in range(repeat):
+        fn, db, items = setup()
+        t0 = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - t0
+        best = seconds if best is None else min(best, seconds)
+        if db is not None: counters = db.counters()
+    result = {'seconds': round(best, 4), 'items': items, 'rows_per_sec': round(items / best, 1) if best else None}
+    if counters: result.update(counters)
+    if memory:
+        # Lượt riêng: tracemalloc làm chậm nên không dùng chung với lượt đo thời gian
+        fn, db, _ = setup()
+        tracemalloc.start()
+        fn()
+        result['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+        tracemalloc.stop()
+    return result
+
+def format_result(key, r):
+    line = f"{key:<40} {r['seconds']:>9.3f}s {r['rows_per_sec'] or 0:>12,.0f} dòng/s"
+    if 'peak_mb' in r: line += f" {r['peak_mb']:>9.1f} MB"
+    if 'reads' in r: line += f"  đọc {r['reads']:,} ghi {r['writes']:,} commit {r['commits']:,}"
+    return line
+
+def run(sizes, hoc_kys, only=None, memory=True, repeat=3):
+    app = load_app()
+    results = {}
+    for n in sizes:
+        for hoc_ky in hoc_kys:
+            for name, setup in stages(app, n, hoc_ky).items():
+                if only and name not in only: continue
+                key = f"{n}/{hoc_ky}/{name}"
+                results[key] = run_stage(setup, memory, repeat)
+                print(format_result(key, results[key]), flush=True)
+    return results
+
+# ==========================================
+# 5. SO SÁNH VỚI BASELINE
+# ==========================================
+def find_regressions(results, baseline, tolerance=0.2):
+    """Tốc độ giảm / bộ nhớ tăng quá tolerance, hoặc số lệnh Firestore tăng (số lệnh là tất định)."""
+    problems = []
+    for key, cur in results.items():
+        old = baseline.get(key)
+        if not old: continue
+        if old.get('rows_per_sec') and cur.get('rows_per_sec') and cur['rows_per_sec'] < old['rows_per_sec'] * (1 - tolerance):
+            problems.append(f"{key}: tốc độ {cur['rows_per_sec']:,.0f} < {old['rows_per_sec']:,.0f} dòng/s")
+        if old.get('peak_mb') and cur.get('peak_mb') and cur['peak_mb'] > old['peak_mb'] * (1 + tolerance):
+            problems.append(f"{key}: bộ nhớ {cur['peak_mb']} > {old['peak_mb']} MB")
+        for op in ('reads', 'writes', 'commits'):
+            if op in old and cur.get(op, 0) > old[op]:
+                problems.append(f"{key}: {op} {cur[op]:,} > {old[op]:,}")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000], help="số học sinh mỗi file (100 - 10000)")
+    parser.add_argument('--hoc-ky', nargs='+', default=["HK1", "CaNam"], choices=list(TITLES))
+    parser.add_argument('--only', nargs='+', help="chỉ chạy các giai đoạn này")
+    parser.add_argument('--no-memory', action='store_true', help="bỏ lượt đo bộ nhớ (nhanh hơn)")
+    parser.add_argument('--repeat', type=int, default=3, help="số lượt đo thời gian, lấy lượt nhanh nhất")
+    parser.add_argument('--save', help="ghi kết quả ra file JSON")
+    parser.add_argument('--baseline', help="file JSON kết quả cũ để so sánh")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="ngưỡng chênh lệch tốc độ / bộ nhớ (mặc định 0.2)")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.hoc_ky, args.only, memory=not args.no_memory, repeat=max(args.repeat, 1))
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f: json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f: problems = find_regressions(results, json.load(f), args.tolerance)
+        for p in problems: print(f"⚠️ HỒI QUY {p}")
+        if problems: return 1
+        print("Không có hồi quy.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
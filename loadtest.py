@@ -0,0 +1,238 @@
+"""Load test đăng nhập ngày công bố điểm: nhiều học sinh cùng đăng nhập và xem bảng điểm.
+
+- Mỗi phiên = 1 AppTest chạy đúng streamlit_app.main(): mở trang, điền form "Đăng nhập",
+  hiện trang học sinh (bảng điểm 3 tab), bật "📊 So sánh với khối".
+- Các phiên chạy song song bằng thread trong cùng process, giống 1 instance Streamlit thật.
+- Database: Firestore trong RAM (benchmark.MemoryFirestore) hoặc Firestore emulator
+  (--emulator, cần biến môi trường FIRESTORE_EMULATOR_HOST).
+- Độ trễ server lấy từ perf_scope của app (PERF_LOG_JSON): "đăng nhập" = lượt chạy xử lý
+  form, "bảng điểm" = mỗi lần render trang học sinh. Độ trễ client = thời gian AppTest chờ.
+
+    python loadtest.py --students 1000 --sessions 200 --concurrency 1 8 32 --save load.json
+    python loadtest.py --sessions 200 --concurrency 8 --baseline load.json   # exit 1 nếu có hồi quy
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import benchmark
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+PASSWORD = "matkhau2024"
+
+# ==========================================
+# 1. CHUẨN BỊ DỮ LIỆU
+# ==========================================
+def connect(emulator=False):
+    """Nạp app để seed dữ liệu; trả về (app, db) với db là client mà mọi phiên AppTest dùng chung."""
+    from firebase_admin import firestore
+    real_client = firestore.client
+    app = benchmark.load_app()
+    if emulator:
+        if not os.environ.get('FIRESTORE_EMULATOR_HOST'): sys.exit("Thiếu FIRESTORE_EMULATOR_HOST")
+        firestore.client = real_client
+        db = firestore.client()
+    else:
+        db = benchmark.MemoryFirestore()
+        firestore.client = lambda app=None: db
+    return app, benchmark.use_db(app, db)
+
+def seed(app, n, nam_hoc="2023-2024"):
+    """n học sinh đã đổi mật khẩu, có điểm HK1 + Cả năm và thống kê khối. Trả về danh sách CCCD."""
+    users = benchmark.make_users(n, nam_hoc)
+    app.bulk_import_users(users)
+    # Đủ lượt đăng nhập cho mọi phiên, vẫn đi qua transaction trừ lượt (không dùng 'full')
+    pw_hash = app.generate_password_hash(PASSWORD)
+    keys = app.store.user_keys()
+    app.store.update_users({keys[cccd]['id']: {'password_hash': pw_hash, 'must_change_password': False,
+                                               'login_status': "100000"} for cccd, *_ in users})
+    app.rebuild_report_cards() # Như project đã "Dựng lại" sau khi triển khai: card do upload ghi là đầy đủ
+    for hoc_ky in ("HK1", "CaNam"):
+        app.process_upload_auto(pd.DataFrame(benchmark.make_score_rows(n, hoc_ky, nam_hoc), dtype=object))
+    return [cccd for cccd, *_ in users]
+
+# ==========================================
+# 2. SỐ LIỆU TỪ PERF SCOPE CỦA APP
+# ==========================================
+class ScopeCollector(logging.Handler):
+    """Nhận log JSON 'scope' (1 / lần render trang) mà streamlit_app ghi khi PERF_LOG_JSON=1."""
+    def __init__(self):
+        super().__init__()
+        self.scopes = []
+
+    def emit(self, record):
+        msg = record.getMessage()
+        if msg.startswith('{"event": "scope"'): self.scopes.append(json.loads(msg))
+
+def install_collector():
+    os.environ['PERF_LOG_JSON'] = '1' # Đọc lại mỗi lần AppTest chạy script
+    collector = ScopeCollector()
+    perf_logger = logging.getLogger("eduscore.perf")
+    perf_logger.addHandler(collector); perf_logger.setLevel(logging.INFO); perf_logger.propagate = False
+    return collector
+
+# ==========================================
+# 3. MỘT PHIÊN HỌC SINH
+# ==========================================
+def allow_concurrent_apptest():
+    """AppTest vốn chạy tuần tự; 2 chỗ cần vá để nhiều phiên chạy song song như 1 instance thật:
+    - mỗi lượt chạy compile lại script (ast.parse song song trên nhiều thread có thể lỗi trên 3.11)
+      -> dùng chung 1 ScriptCache, giống Runtime thật compile 1 lần / process;
+    - cuối mỗi lượt AppTest gán Runtime._instance = None làm hỏng lượt đang chạy ở thread khác
+      -> Runtime.instance() dùng lại runtime giả gần nhất."""
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+    shared = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: shared
+
+    last = []
+    def instance(cls):
+        if cls._instance is not None: last[:] = [cls._instance]
+        elif not last: raise RuntimeError("Runtime hasn't been created!")
+        return last[0]
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or bool(last))
+
+def run_session(cccd, timeout=60):
+    try: return _session(cccd, timeout)
+    except Exception as e: return {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+
+def _session(cccd, timeout):
+    from streamlit.testing.v1 import AppTest
+    timings, t0 = {}, time.perf_counter()
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout).run()
+    timings['open'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    at.text_input[0].input(cccd); at.text_input[1].input(PASSWORD)
+    at.button[0].click().run()
+    timings['login'] = time.perf_counter() - t0
+    if at.exception or not at.toggle:
+        errors = [e.value for e in at.exception] + [e.value for e in at.error]
+        return {**timings, 'ok': False, 'error': "; ".join(map(str, errors)) or "Không vào được trang học sinh"}
+
+    t0 = time.perf_counter()
+    at.toggle[0].set_value(True).run()
+    timings['compare'] = time.perf_counter() - t0
+    if at.exception: return {**timings, 'ok': False, 'error': str(at.exception[0].value)}
+    return {**timings, 'ok': True, 'error': None}
+
+# ==========================================
+# 4. CHẠY TẢI + BÁO CÁO
+# ==========================================
+def percentiles(values_s):
+    """Giây -> {p50, p95, p99, max} tính bằng ms."""
+    if not values_s: return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    ms = np.asarray(values_s) * 1000
+    return {'p50': round(float(np.percentile(ms, 50)), 1), 'p95': round(float(np.percentile(ms, 95)), 1),
+            'p99': round(float(np.percentile(ms, 99)), 1), 'max': round(float(ms.max()), 1)}
+
+def run_load(students, sessions, concurrency, collector, db, timeout=60, offset=0):
+    """Chạy `sessions` phiên với `concurrency` thread, mỗi phiên 1 học sinh khác nhau bắt đầu từ `offset`
+    (xoay vòng khi hết học sinh: bảng điểm đã nằm trong cache nên lượt đọc thấp hơn thực tế)."""
+    collector.scopes.clear()
+    before = db.counters() if hasattr(db, 'counters') else None
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda i: run_session(students[(offset + i) % len(students)], timeout), range(sessions)))
+    wall = time.perf_counter() - t0
+
+    scopes = list(collector.scopes)
+    login = [s for s in scopes if s['name'] == 'page:login' and s['calls']] # Bỏ lượt render form trống
+    student = [s for s in scopes if s['name'] == 'page:student']
+    ok = [r for r in results if r['ok']]
+    report = {
+        'sessions': sessions, 'concurrency': concurrency, 'failed': sessions - len(ok),
+        'seconds': round(wall, 3), 'sessions_per_sec': round(len(ok) / wall, 2),
+        'latency_ms': {
+            'login': percentiles([s['total_ms'] / 1000 for s in login]),
+            'report': percentiles([s['total_ms'] / 1000 for s in student]),
+            'open (client)': percentiles([r['open'] for r in results if 'open' in r]),
+            'login → report (client)': percentiles([r['login'] for r in results if 'login' in r]),
+            'compare (client)': percentiles([r['compare'] for r in ok]),
+        },
+        'reads_per_session': round(sum(s['reads'] for s in scopes) / sessions, 2),
+        'reads_by_page': {name: round(sum(s['reads'] for s in scopes if s['name'] == name) / sessions, 2)
+                          for name in sorted({s['name'] for s in scopes})},
+        'writes_per_session': round(sum(s['writes'] for s in scopes) / sessions, 2),
+        'errors': sorted({r['error'] for r in results if r['error']})[:5],
+    }
+    if before is not None:
+        # Đối chiếu: tổng lượt đọc thật của database (gồm cả lệnh không qua perf_record nếu có)
+        report['db_reads_per_session'] = round((db.counters()['reads'] - before['reads']) / sessions, 2)
+    return report
+
+def format_report(r):
+    lines = [f"concurrency={r['concurrency']}: {r['sessions']} phiên ({r['failed']} lỗi) trong {r['seconds']:.1f}s"
+             f" -> {r['sessions_per_sec']:.2f} phiên/s",
+             f"  {'Độ trễ (ms)':<26}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"]
+    for name, p in r['latency_ms'].items():
+        lines.append(f"  {name:<26}" + "".join(f"{v:>9,.1f}" if v is not None else f"{'-':>9}" for v in p.values()))
+    by_page = ", ".join(f"{k} {v:g}" for k, v in r['reads_by_page'].items())
+    lines.append(f"  Đọc / phiên: {r['reads_per_session']:g} ({by_page}); ghi / phiên: {r['writes_per_session']:g}")
+    if 'db_reads_per_session' in r: lines.append(f"  Đọc / phiên theo database: {r['db_reads_per_session']:g}")
+    for e in r['errors']: lines.append(f"  ⚠️ {e}")
+    return "\n".join(lines)
+
+def find_regressions(results, baseline, tolerance=0.2):
+    """Phiên/s giảm, p95 tăng quá tolerance, số lượt đọc / phiên tăng, hoặc có phiên lỗi."""
+    problems = []
+    for key, cur in results.items():
+        if cur['failed']: problems.append(f"{key}: {cur['failed']} phiên lỗi")
+        old = baseline.get(key)
+        if not old: continue
+        if cur['sessions_per_sec'] < old['sessions_per_sec'] * (1 - tolerance):
+            problems.append(f"{key}: {cur['sessions_per_sec']:.2f} < {old['sessions_per_sec']:.2f} phiên/s")
+        for name in ('login', 'report'):
+            a, b = old['latency_ms'][name]['p95'], cur['latency_ms'][name]['p95']
+            if a and b and b > a * (1 + tolerance): problems.append(f"{key}: p95 {name} {b:,.1f} > {a:,.1f} ms")
+        if cur['reads_per_session'] > old['reads_per_session']:
+            problems.append(f"{key}: đọc / phiên {cur['reads_per_session']:g} > {old['reads_per_session']:g}")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=1000,
+                        help="số học sinh seed vào database (nên >= sessions x số mức concurrency)")
+    parser.add_argument('--sessions', type=int, default=200, help="số phiên mỗi mức concurrency")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help="số phiên chạy đồng thời")
+    parser.add_argument('--emulator', action='store_true', help="dùng Firestore emulator thay vì Firestore trong RAM")
+    parser.add_argument('--timeout', type=float, default=60, help="timeout mỗi lượt chạy script (giây)")
+    parser.add_argument('--save', help="ghi kết quả ra file JSON")
+    parser.add_argument('--baseline', help="file JSON kết quả cũ để so sánh")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="ngưỡng chênh lệch phiên/s và p95 (mặc định 0.2)")
+    args = parser.parse_args(argv)
+
+    app, db = connect(args.emulator)
+    t0 = time.perf_counter()
+    students = seed(app, args.students)
+    print(f"Seed {len(students)} học sinh: {time.perf_counter() - t0:.1f}s", flush=True)
+    collector = install_collector()
+    allow_concurrent_apptest()
+    warm = run_session(students[0], args.timeout) # Khởi tạo cache_resource (store, bootstrap) trước khi đo
+    if not warm['ok']: sys.exit(f"Phiên thử lỗi: {warm['error']}")
+
+    results = {}
+    for i, c in enumerate(args.concurrency):
+        key = f"{args.sessions}x{c}"
+        results[key] = run_load(students, args.sessions, c, collector, db, args.timeout, offset=1 + i * args.sessions)
+        print(format_report(results[key]), flush=True)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f: json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f: problems = find_regressions(results, json.load(f), args.tolerance)
+        for p in problems: print(f"⚠️ HỒI QUY {p}")
+        if problems: return 1
+        print("Không có hồi quy.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
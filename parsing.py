@@ -0,0 +1,416 @@
+"""Parser file điểm Excel (VnEdu / SMAS): thuần pandas/numpy, không dùng Streamlit hay database.
+
+Tách riêng khỏi streamlit_app.py để process con của pool parse import được mà không phải chạy lại
+cả app (Streamlit chạy script như module __main__ tạo mới mỗi lần rerun -> không pickle được hàm trong đó).
+"""
+import re
+import io
+import itertools
+import json
+import logging
+import os
+import hashlib
+import tempfile
+import threading
+import time
+import pandas as pd
+import numpy as np
+import openpyxl
+import xlrd
+
+# ==========================================
+# 1. NHẬN DẠNG SHEET ĐIỂM
+# ==========================================
+
+def clean_str(val):
+    if pd.isna(val) or str(val).strip() == '': return None
+    s = str(val).strip()
+    return s.replace('.0', '') if s.endswith('.0') and len(s) > 2 else s
+
+def detect_file_info(df):
+    # Nối text 15 dòng đầu (không cần format bảng như to_string)
+    head = df.head(15).to_numpy(dtype=object).ravel()
+    content = " ".join(str(v) for v in head[~pd.isna(head)])
+    year_match = re.search(r'(\d{4})\s*-\s*(\d{4})', content)
+    nam_hoc = f"{year_match.group(1)}-{year_match.group(2)}" if year_match else None
+    
+    if "Học kỳ 1" in content or "HỌC KỲ 1" in content: hoc_ky = "HK1"
+    elif "Học kỳ 2" in content or "HỌC KỲ 2" in content: hoc_ky = "HK2"
+    else: hoc_ky = "CaNam"
+    return nam_hoc, hoc_ky
+
+def _sheet_text(df):
+    # Chuyển sheet sang mảng chuỗi đúng 1 lần (thay cho str(df.iat[r, c]) từng ô)
+    raw = df.to_numpy(dtype=object)
+    text = np.vectorize(str, otypes=[object])(raw) if raw.size else raw
+    return raw, text, pd.isna(raw)
+
+def _str_contains(cells, pat):
+    return cells.str.contains(pat, regex=False).to_numpy(dtype=bool)
+
+def _clean_cells(text_vals, na_vals):
+    # Bản vectorized của clean_str cho 1 dãy ô
+    s = pd.Series(text_vals, dtype=object).str.strip()
+    trim = (s.str.endswith('.0') & (s.str.len() > 2)).to_numpy(dtype=bool)
+    out = s.to_numpy(dtype=object, copy=True)
+    if trim.any():
+        out[trim] = s[trim].str.replace('.0', '', regex=False).to_numpy(dtype=object)
+    out[na_vals | (s == '').to_numpy(dtype=bool)] = None
+    return out
+
+def _first_index(mask):
+    # Cột đầu tiên True trên từng dòng của mask 2D, -1 nếu không có
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), -1)
+
+def _last_index(mask):
+    return np.where(mask.any(axis=1), mask.shape[1] - 1 - mask[:, ::-1].argmax(axis=1), -1)
+
+def _map_score_columns(h_low, hoc_ky):
+    # h_low: mảng 2D các dòng header (lower) -> mảng (n, 4) chỉ số cột TX, GK, CK, TB
+    cells = pd.Series(h_low.ravel(), dtype=object)
+    has = lambda pat: _str_contains(cells, pat).reshape(h_low.shape)
+    is_tb = (cells == "tb").to_numpy(dtype=bool).reshape(h_low.shape) | has("tbm")
+    cols = np.full((h_low.shape[0], 4), -1)
+    if hoc_ky == "CaNam":
+        # "Cả năm" luôn được ưu tiên, nếu không có thì lấy cột TB/TBM đầu tiên
+        col_cn = _last_index(has("cả năm"))
+        cols[:, 3] = np.where(col_cn != -1, col_cn, _first_index(is_tb))
+        return cols
+    is_tx = has("tx")
+    is_gk = has("gk") & ~is_tx
+    is_ck = has("ck") & ~is_tx & ~is_gk
+    is_tb &= ~is_tx & ~is_gk & ~is_ck
+    for j, mask in enumerate([is_tx, is_gk, is_ck, is_tb]):
+        cols[:, j] = _last_index(mask)
+    return cols
+
+def _parse_assessment(row_texts):
+    # row_texts: tối đa 15 dòng (đã nối " | ") ngay sau bảng điểm
+    k_ht = k_rl = dh = nx = None
+    for row_txt in row_texts:
+        if "KQHT" in row_txt or "Học lực" in row_txt:
+            for p in row_txt.split('|'):
+                if "KQHT" in p or "Học lực" in p: k_ht = p.split(':')[-1].strip()
+                if "KQRL" in p or "Hạnh kiểm" in p: k_rl = p.split(':')[-1].strip()
+                if "Danh hiệu" in p: dh = p.split(':')[-1].strip()
+        if "Nhận xét" in row_txt: nx = row_txt.split(':')[-1].strip()
+    return k_ht, k_rl, dh, nx
+
+# Cache bố cục theo mẫu file: các file xuất từ cùng mẫu VnEdu/SMAS có "Mã HS", header "Môn học",
+# cột TX/GK/CK/TB và dòng đánh giá ở cùng vị trí -> lưu vị trí đã dò (file JSON, dùng chung mọi
+# process), lần sau chỉ dò cột "Mã HS" và kiểm tra vài ô header thay vì quét toàn bộ sheet.
+LAYOUT_CACHE_PATH = os.environ.get('LAYOUT_CACHE_PATH') or os.path.join(tempfile.gettempdir(), 'eduscore_layouts.json')
+LAYOUT_CACHE_VERSION = 1 # Tăng khi đổi logic parse để bỏ bố cục cũ
+LAYOUT_CACHE_SIZE = 200
+_LAYOUT_LABELS = ("mã hs", "họ và tên", "lớp", "môn", "tx", "gk", "ck", "tb", "cả năm", "kết quả")
+_layout_cache = {'lock': threading.Lock(), 'layouts': None}
+
+def layout_fingerprint(head, hoc_ky):
+    """Khóa bố cục của sheet: vị trí các nhãn của mẫu trong 15 dòng đầu (không phụ thuộc tên / điểm)."""
+    _, text, _ = _sheet_text(head.head(15))
+    low = pd.Series(text.ravel(), dtype=object).str.lower().to_numpy(dtype=object).reshape(text.shape)
+    labels = [[r, c, label] for (r, c), cell in np.ndenumerate(low) for label in _LAYOUT_LABELS if label in cell]
+    return hashlib.sha1(json.dumps([hoc_ky, labels], ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+def _read_layouts():
+    try:
+        with open(LAYOUT_CACHE_PATH, encoding='utf-8') as f: data = json.load(f)
+    except (OSError, ValueError): return {}
+    return data.get('layouts', {}) if data.get('version') == LAYOUT_CACHE_VERSION else {}
+
+def get_layout(key):
+    with _layout_cache['lock']:
+        layouts = _layout_cache['layouts']
+        if layouts is None or key not in layouts:
+            # Chưa có trong RAM: đọc lại file (process khác / job upload trước có thể đã lưu)
+            layouts = _layout_cache['layouts'] = _read_layouts()
+        return layouts.get(key)
+
+def save_layout(key, layout):
+    # layout=None: xóa bố cục của key
+    with _layout_cache['lock']:
+        layouts = _read_layouts()
+        if layout is None: layouts.pop(key, None)
+        else: layouts[key] = {**layout, 'saved_at': time.time()}
+        layouts = dict(sorted(layouts.items(), key=lambda kv: kv[1].get('saved_at', 0))[-LAYOUT_CACHE_SIZE:])
+        _layout_cache['layouts'] = layouts
+        tmp = f"{LAYOUT_CACHE_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f: json.dump({'version': LAYOUT_CACHE_VERSION, 'layouts': layouts}, f, ensure_ascii=False)
+            os.replace(tmp, LAYOUT_CACHE_PATH) # Ghi nguyên tử: process khác không đọc phải file dở
+        except OSError: logging.getLogger(__name__).warning("Không ghi được cache bố cục %s", LAYOUT_CACHE_PATH)
+
+def _ma_hs_at(text, r, c):
+    # Mã HS nằm ngay trong ô "Mã HS: xxx" hoặc ở 1 trong 5 ô bên phải
+    val = text[r, c].strip()
+    if ":" in val and len(val.split(':')[-1].strip()) > 3:
+        return val.split(':')[-1].strip()
+    for cand in text[r, c + 1:c + 6]:
+        cand = cand.strip()
+        if len(cand) > 4 and cand[0].isdigit(): return cand
+    return ""
+
+def _is_assessment_row(row_txt):
+    return "KQHT" in row_txt or "Học lực" in row_txt or "Nhận xét" in row_txt
+
+def _detect_blocks(text, hoc_ky, anchor_rows):
+    """Dò đầy đủ: quét mọi ô tìm "Mã HS", header "Môn học" trong 8 dòng sau, map cột theo nhãn header.
+
+    Trả về (students, anchors, headers, col_maps): anchors[block] = (dòng, cột) ô "Mã HS",
+    headers = [(block, dòng header, cột môn)], col_maps[i] = cột TX, GK, CK, TB của headers[i].
+    """
+    col_count = text.shape[1]
+    cells = pd.Series(text.ravel(), dtype=object)
+    found = np.flatnonzero(_str_contains(cells, "Mã HS"))
+    if anchor_rows is not None: found = found[found < anchor_rows * col_count]
+    low_cells = cells.str.lower()
+    is_mon = (_str_contains(low_cells, "môn") & _str_contains(low_cells, "học")).reshape(text.shape)
+    low = low_cells.to_numpy(dtype=object).reshape(text.shape)
+
+    students, anchors, headers = [], [], []
+    for idx in found:
+        r, c = divmod(int(idx), col_count)
+        ma_hs = _ma_hs_at(text, r, c)
+        if not ma_hs: continue
+        block = len(students)
+        students.append(ma_hs.replace('.0', '')); anchors.append((r, c))
+
+        window = is_mon[r + 1:r + 9]
+        if window.any():
+            k, col_mon = divmod(int(window.argmax()), col_count)
+            headers.append((block, r + 1 + k, col_mon))
+    col_maps = _map_score_columns(low[[h[1] for h in headers]], hoc_ky) if headers else np.empty((0, 4), dtype=int)
+    return students, anchors, headers, col_maps
+
+def _blocks_from_layout(text, layout, anchor_rows):
+    """Dò theo bố cục đã cache: chỉ quét cột "Mã HS", kiểm tra ô "Môn học" + nhãn các cột điểm
+    của từng khối. Cùng kết quả với _detect_blocks; None nếu có ô không khớp (-> dò đầy đủ)."""
+    row_count, col_count = text.shape
+    col, col_mon, cols = layout['anchor_col'], layout['col_mon'], layout['cols']
+    if max(col, col_mon, *cols) >= col_count: return None
+    rows = np.flatnonzero(_str_contains(pd.Series(text[:, col], dtype=object), "Mã HS"))
+    if anchor_rows is not None: rows = rows[rows < anchor_rows]
+    if not len(rows): return None
+    # Khoảng cách 2 khối dài hơn lúc dò -> có thể có "Mã HS" lệch cột bị bỏ sót
+    if layout['block_rows'] and len(rows) > 1 and int(np.diff(rows).max()) > layout['block_rows']: return None
+    # Trước khối đầu / sau khối cuối cũng không được có "Mã HS" lệch cột (vd. học sinh cuối sheet)
+    limit = row_count if anchor_rows is None else min(anchor_rows, row_count)
+    for lo, hi in ((0, int(rows[0])), (int(rows[-1]) + 1, limit)):
+        hits = np.flatnonzero(_str_contains(pd.Series(text[lo:hi].ravel(), dtype=object), "Mã HS"))
+        if any(_ma_hs_at(text, lo + int(i) // col_count, int(i) % col_count) for i in hits): return None
+
+    students, anchors, headers = [], [], []
+    for r in rows:
+        r = int(r)
+        ma_hs = _ma_hs_at(text, r, col)
+        if not ma_hs: continue
+        header_row = r + layout['header_offset']
+        if header_row >= row_count: return None
+        mon = text[header_row, col_mon].lower()
+        if "môn" not in mon or "học" not in mon: return None
+        if any(c != -1 and text[header_row, c].lower() != label for c, label in zip(cols, layout['labels'])): return None
+        block = len(students)
+        students.append(ma_hs.replace('.0', '')); anchors.append((r, col))
+        headers.append((block, header_row, col_mon))
+    return students, anchors, headers, np.tile(np.asarray(cols), (len(headers), 1))
+
+def _learn_layout(text, anchors, headers, col_maps, spans):
+    """Bố cục để cache từ kết quả dò đầy đủ; None nếu chưa đủ 2 khối hoặc các khối không cùng 1 bố cục."""
+    if len(headers) < 2 or len(headers) != len(anchors): return None
+    anchor_cols = {anchors[b][1] for b, _, _ in headers}
+    offsets = {header_row - anchors[b][0] for b, header_row, _ in headers}
+    col_mons = {col_mon for _, _, col_mon in headers}
+    maps = {tuple(int(x) for x in m) for m in col_maps}
+    if len(anchor_cols) > 1 or len(offsets) > 1 or len(col_mons) > 1 or len(maps) > 1: return None
+    cols = list(maps.pop())
+    labels = [text[headers[0][1], c].lower() if c != -1 else None for c in cols]
+    if any(c != -1 and text[h, c].lower() != label for _, h, _ in headers for c, label in zip(cols, labels)): return None
+    rows = sorted(r for r, _ in anchors)
+    # CaNam: số dòng bảng điểm + vị trí dòng đánh giá (so với cuối bảng) giống nhau ở mọi khối mới cache
+    span, assessment_rows = spans[0] if spans and len(set(spans)) == 1 and spans[0][1] else (None, None)
+    return {'anchor_col': anchor_cols.pop(), 'header_offset': offsets.pop(), 'col_mon': col_mons.pop(), 'cols': cols,
+            'labels': labels, 'block_rows': int(np.diff(rows).max()),
+            'span': span, 'assessment_rows': list(assessment_rows) if assessment_rows is not None else None}
+
+def parse_score_sheet(df, hoc_ky, anchor_rows=None, layout_key=None):
+    """Tách sheet điểm thành các bảng gọn, không phụ thuộc database.
+
+    anchor_rows: chỉ lấy các ô "Mã HS" nằm trong ngần ấy dòng đầu (dùng khi đọc
+    theo từng đoạn, phần dòng còn lại chỉ để nhìn tiếp header/điểm/đánh giá).
+    layout_key: khóa bố cục (layout_fingerprint); bố cục cache còn khớp -> bỏ bước quét
+    toàn sheet, không khớp -> dò đầy đủ rồi cache lại bố cục mới.
+
+    Trả về (students, scores, assessments):
+    - students: 1 dòng / khối "Mã HS" (index = block), cột ma_hs
+    - scores: block, ma_hs, mon_hoc, tx, gk, ck, tb
+    - assessments (chỉ CaNam): block, ma_hs, kq_hoc_tap, kq_ren_luyen, danh_hieu, nhan_xet
+    """
+    raw, text, na = _sheet_text(df)
+    row_count, col_count = text.shape
+
+    # Bước 1: xác định mã HS, dòng header và cột điểm cho từng khối (theo bố cục cache nếu khớp)
+    layout = get_layout(layout_key) if layout_key else None
+    found = _blocks_from_layout(text, layout, anchor_rows) if layout else None
+    if found is None: layout = None; found = _detect_blocks(text, hoc_ky, anchor_rows)
+    students, anchors, headers, col_maps = found
+
+    # Bước 2: đọc các dòng môn học
+    row_texts = {}
+    score_rows, ass_rows = [], []
+    pick_rows, pick_cols = [], []
+    spans = [] # (số dòng bảng điểm, vị trí dòng đánh giá) từng khối, để học bố cục
+    stale = False
+    def row_text(x):
+        if x not in row_texts: row_texts[x] = " | ".join(text[x][~na[x]])
+        return row_texts[x]
+    for (block, header_row, col_mon), col_map in zip(headers, col_maps):
+        col_tx, col_gk, col_ck, col_tb = (int(x) for x in col_map)
+        curr = header_row + 1; last_row = curr
+        for _ in range(25):
+            if curr >= row_count: break
+            mon = text[curr, col_mon].strip()
+            if not mon or mon.lower() == 'nan' or "kết quả" in mon.lower() or "xếp loại" in mon.lower():
+                last_row = curr; break
+            # Dòng STT (toàn số): bản cũ lặp lại cùng dòng đến hết vòng -> tương đương dừng đọc
+            if mon.isdigit(): break
+            if hoc_ky == "CaNam" and not (clean_str(raw[curr, col_tb]) if col_tb != -1 else None):
+                curr += 1; continue
+            score_rows.append((block, students[block], mon))
+            pick_rows.append(curr); pick_cols.append((col_tx, col_gk, col_ck, col_tb))
+            curr += 1; last_row = curr
+
+        if hoc_ky == "CaNam":
+            # Bảng điểm dài đúng như bố cục cache -> chỉ đọc các dòng đánh giá đã biết (phải đúng là dòng đánh giá)
+            chk_texts = None
+            if layout is not None and layout['span'] == last_row - header_row:
+                chk_texts = [row_text(x) for x in (last_row + o for o in layout['assessment_rows']) if x < row_count]
+                if not all(_is_assessment_row(t) for t in chk_texts): chk_texts = None; stale = True
+            if chk_texts is None:
+                chk_texts = [row_text(x) for x in range(last_row, min(last_row + 15, row_count))]
+                spans.append((last_row - header_row, tuple(o for o, t in enumerate(chk_texts) if _is_assessment_row(t))))
+            k_ht, k_rl, dh, nx = _parse_assessment(chk_texts)
+            if k_ht or k_rl or dh:
+                ass_rows.append((block, students[block], k_ht, k_rl, dh, nx))
+
+    if layout_key and layout is None:
+        learned = _learn_layout(text, anchors, headers, col_maps, spans)
+        if learned and learned != {k: v for k, v in (get_layout(layout_key) or {}).items() if k != 'saved_at'}:
+            save_layout(layout_key, learned)
+    elif stale: save_layout(layout_key, None) # Dòng đánh giá đã đổi chỗ: bỏ bố cục, lần sau dò lại
+
+    # Bước 3: lấy giá trị điểm hàng loạt
+    # dtype=object để giữ None (không bị ép thành NaN)
+    scores = pd.DataFrame(score_rows, columns=['block', 'ma_hs', 'mon_hoc'], dtype=object)
+    if score_rows:
+        rows = np.asarray(pick_rows)
+        cols = np.asarray(pick_cols)
+        for j, name in enumerate(['tx', 'gk', 'ck', 'tb']):
+            has = cols[:, j] != -1
+            vals = np.full(len(rows), None, dtype=object)
+            if has.any():
+                rr, cc = rows[has], cols[has, j]
+                vals[has] = _clean_cells(text[rr, cc], na[rr, cc])
+            scores[name] = pd.Series(vals, index=scores.index, dtype=object)
+    else:
+        for name in ['tx', 'gk', 'ck', 'tb']: scores[name] = pd.Series(dtype=object)
+
+    students = pd.DataFrame({'ma_hs': students})
+    students.index.name = 'block'
+    assessments = pd.DataFrame(ass_rows, columns=['block', 'ma_hs', 'kq_hoc_tap', 'kq_ren_luyen', 'danh_hieu', 'nhan_xet'], dtype=object)
+    return students, scores, assessments
+
+# ==========================================
+# 2. ĐỌC FILE DẠNG LUỒNG
+# ==========================================
+# Đọc file dạng luồng: openpyxl read_only / xlrd on_demand, không dựng cả sheet thành DataFrame.
+# 1 khối học sinh dùng tối đa ~49 dòng kể từ dòng "Mã HS" (header ≤ 8, môn ≤ 25, đánh giá ≤ 15),
+# nên mỗi đoạn CHUNK_ROWS dòng được đọc kèm STUDENT_BLOCK_ROWS dòng gối đầu sang đoạn sau.
+STUDENT_BLOCK_ROWS = 50
+CHUNK_ROWS = 2000
+
+def _openpyxl_value(cell):
+    # Giống pd.read_excel: ô trống/lỗi -> NaN, số nguyên giữ kiểu int
+    if cell.value is None or cell.value == "" or cell.data_type == 'e': return np.nan
+    if cell.data_type == 'n' and int(cell.value) == cell.value: return int(cell.value)
+    return cell.value
+
+def _xlrd_value(cell, datemode):
+    if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR) or cell.value == "": return np.nan
+    if cell.ctype == xlrd.XL_CELL_DATE: return xlrd.xldate.xldate_as_datetime(cell.value, datemode)
+    if cell.ctype == xlrd.XL_CELL_BOOLEAN: return bool(cell.value)
+    if cell.ctype == xlrd.XL_CELL_NUMBER and int(cell.value) == cell.value: return int(cell.value)
+    return cell.value
+
+def iter_workbook_sheets(name, data):
+    """Yield (tên sheet, iterator các dòng) cho mọi sheet trong file.
+
+    Phải đọc hết iterator dòng của sheet trước khi sang sheet sau.
+    """
+    if name.endswith('.xls'):
+        book = xlrd.open_workbook(file_contents=data, on_demand=True)
+        try:
+            for i in range(book.nsheets):
+                sh = book.sheet_by_index(i)
+                yield sh.name, ([_xlrd_value(c, book.datemode) for c in sh.row(r)] for r in range(sh.nrows))
+                book.unload_sheet(i)
+        finally: book.release_resources()
+    else:
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            for ws in wb.worksheets:
+                ws.reset_dimensions()
+                yield ws.title, ([_openpyxl_value(c) for c in row] for row in ws.iter_rows())
+        finally: wb.close()
+
+def _rows_frame(rows):
+    width = max((len(r) for r in rows), default=0)
+    return pd.DataFrame([r + [np.nan] * (width - len(r)) for r in rows], dtype=object)
+
+def iter_sheet_chunks(rows, chunk_rows=CHUNK_ROWS, overlap=STUDENT_BLOCK_ROWS):
+    """Cắt luồng dòng thành các đoạn (DataFrame, anchor_rows) có gối đầu.
+
+    Chỉ "Mã HS" trong anchor_rows dòng đầu thuộc đoạn này; bộ nhớ giữ tối đa
+    chunk_rows + overlap dòng bất kể file lớn cỡ nào.
+    """
+    buf = []
+    for row in rows:
+        buf.append(row)
+        if len(buf) >= chunk_rows + overlap:
+            yield _rows_frame(buf), chunk_rows
+            buf = buf[chunk_rows:]
+    if buf: yield _rows_frame(buf), len(buf)
+
+def _concat_parsed(parts):
+    # Ghép kết quả parse các đoạn, đánh lại số block cho liên tục
+    students, scores, assessments = [], [], []
+    offset = 0
+    for st_df, sc_df, as_df in parts:
+        students.append(st_df.set_axis(st_df.index + offset))
+        scores.append(sc_df.assign(block=sc_df['block'] + offset))
+        assessments.append(as_df.assign(block=as_df['block'] + offset))
+        offset += len(st_df)
+    students = pd.concat(students).rename_axis('block')
+    return students, pd.concat(scores, ignore_index=True), pd.concat(assessments, ignore_index=True)
+
+def parse_score_rows(rows):
+    """Parse 1 sheet dạng luồng. Trả về (nam_hoc, hoc_ky, students, scores, assessments), None nếu không có năm học."""
+    rows = iter(rows)
+    head = list(itertools.islice(rows, 15))
+    head_df = _rows_frame(head)
+    nam_hoc, hoc_ky = detect_file_info(head_df)
+    if not nam_hoc: return None
+    key = layout_fingerprint(head_df, hoc_ky) # Đoạn đầu dò + cache bố cục, các đoạn sau dùng lại
+    parts = [parse_score_sheet(chunk, hoc_ky, anchor_rows=n, layout_key=key) for chunk, n in iter_sheet_chunks(itertools.chain(head, rows))]
+    return (nam_hoc, hoc_ky, *_concat_parsed(parts))
+
+def parse_score_file(name, data):
+    """Đọc + parse mọi sheet của 1 file điểm (chạy trong process con). Trả về dict kết quả."""
+    sheets = []
+    for sheet_name, rows in iter_workbook_sheets(name, data):
+        parsed = parse_score_rows(rows)
+        if parsed is None: continue # Sheet không có năm học (hướng dẫn, tổng hợp...)
+        nam_hoc, hoc_ky, students, scores, assessments = parsed
+        sheets.append({'sheet': sheet_name, 'nam_hoc': nam_hoc, 'hoc_ky': hoc_ky,
+                       'students': students, 'scores': scores, 'assessments': assessments})
+    if not sheets: return {'error': "Không tìm thấy 'Năm học' trong file."}
+    return {'sheets': sheets}
@@ -1,40 +1,764 @@
 import streamlit as st
 import pandas as pd
-import re
+import numpy as np
+import io
+import pickle
+import tempfile
+import contextlib
+import contextvars
+import collections
+import json
+import logging
+import os
+import hmac
+import hashlib
+import time
+import uuid
+import threading
+import importlib.machinery
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor, as_completed, wait
+import openpyxl
 import firebase_admin
 from firebase_admin import credentials, firestore
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from werkzeug.security import generate_password_hash, check_password_hash
+# Parser file điểm (module riêng để process con của pool parse import được)
+from parsing import detect_file_info, layout_fingerprint, parse_score_sheet, parse_score_file
 
 # ==========================================
-# 1. KẾT NỐI FIREBASE
+# 1. KẾT NỐI DATABASE
 # ==========================================
-# Kiểm tra xem app đã kết nối chưa để tránh lỗi init lại
-if not firebase_admin._apps:
-    # Lấy thông tin từ Streamlit Secrets
-    key_dict = dict(st.secrets["firebase"])
-    cred = credentials.Certificate(key_dict)
-    firebase_admin.initialize_app(cred)
+# Khởi tạo 1 lần / process (cache_resource), các lần rerun chỉ lấy lại client đã có
+@st.cache_resource(show_spinner=False)
+def get_db():
+    # Kiểm tra xem app đã kết nối chưa để tránh lỗi init lại
+    if not firebase_admin._apps:
+        # Lấy thông tin từ Streamlit Secrets
+        key_dict = dict(st.secrets["firebase"])
+        cred = credentials.Certificate(key_dict)
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
 
-db = firestore.client()
+# Đo lường truy cập database: mỗi lệnh được ghi vào registry dùng chung (mọi phiên) và cộng dồn
+# vào "scope" hiện tại = 1 lần render trang hoặc 1 job upload. PERF_LOG_JSON=1 -> log JSON từng lệnh.
+PERF_LOG_JSON = os.environ.get('PERF_LOG_JSON', '').lower() in ('1', 'true', 'yes')
+perf_logger = logging.getLogger("eduscore.perf")
+if PERF_LOG_JSON and not perf_logger.handlers:
+    perf_logger.addHandler(logging.StreamHandler()); perf_logger.setLevel(logging.INFO); perf_logger.propagate = False
+
+@st.cache_resource(show_spinner=False)
+def _perf_registry():
+    return {'lock': threading.Lock(), 'calls': collections.deque(maxlen=20000), 'scopes': collections.deque(maxlen=1000),
+            'scope_var': contextvars.ContextVar('perf_scope', default=None)}
+
+# Mỗi lần rerun Streamlit chạy lại script (module mới) nhưng store trong cache_resource vẫn giữ
+# perf_record của lần chạy đầu -> ContextVar phải nằm trong cache để mọi lần chạy dùng chung.
+_perf_scope = _perf_registry()['scope_var']
+
+def perf_record(op, call, seconds, docs=0, reads=0, writes=0):
+    scope = _perf_scope.get()
+    rec = {'ts': time.time(), 'scope': scope['name'] if scope else 'other', 'op': op, 'call': call,
+           'docs': docs, 'reads': reads, 'writes': writes, 'ms': round(seconds * 1000, 3)}
+    registry = _perf_registry()
+    with registry['lock']:
+        registry['calls'].append(rec)
+        if scope:
+            scope['calls'] += 1; scope['reads'] += reads; scope['writes'] += writes; scope['db_ms'] += rec['ms']
+    if PERF_LOG_JSON: perf_logger.info(json.dumps({'event': 'db_call', **rec}, ensure_ascii=False))
+
+@contextlib.contextmanager
+def perf_scope(name):
+    """Gom các lệnh database trong khối lệnh (1 lần render trang / 1 job upload) thành 1 dòng thống kê."""
+    scope = {'name': name, 'ts': time.time(), 'calls': 0, 'reads': 0, 'writes': 0, 'db_ms': 0.0}
+    token = _perf_scope.set(scope)
+    t0 = time.perf_counter()
+    try: yield scope
+    finally:
+        _perf_scope.reset(token)
+        scope['total_ms'] = round((time.perf_counter() - t0) * 1000, 3)
+        registry = _perf_registry()
+        with registry['lock']: registry['scopes'].append(scope)
+        if PERF_LOG_JSON: perf_logger.info(json.dumps({'event': 'scope', **scope}, ensure_ascii=False))
+
+def perf_tables():
+    """(thống kê theo lệnh, theo trang / job upload) từ registry; nhiều lượt đọc / ghi nhất lên đầu."""
+    registry = _perf_registry()
+    with registry['lock']:
+        calls, scopes = pd.DataFrame(list(registry['calls'])), pd.DataFrame(list(registry['scopes']))
+    p50, p95 = (lambda x: x.quantile(0.5)), (lambda x: x.quantile(0.95))
+    by_op = by_scope = pd.DataFrame()
+    if not calls.empty:
+        by_op = calls.groupby(['op', 'call']).agg(
+            n=('ms', 'size'), docs=('docs', 'sum'), reads=('reads', 'sum'), writes=('writes', 'sum'),
+            p50=('ms', p50), p95=('ms', p95), total=('ms', 'sum'))
+        by_op = by_op.sort_values(['reads', 'writes', 'total'], ascending=False).reset_index().rename(columns={
+            'op': 'Lệnh', 'call': 'Loại', 'n': 'Số lần gọi', 'docs': 'Document', 'reads': 'Lượt đọc', 'writes': 'Lượt ghi',
+            'p50': 'p50 (ms)', 'p95': 'p95 (ms)', 'total': 'Tổng (ms)'})
+    if not scopes.empty:
+        # Trang gộp theo tên (page:login / page:student / page:admin), mỗi job upload 1 dòng
+        by_scope = scopes.groupby('name').agg(
+            n=('total_ms', 'size'), reads=('reads', 'mean'), writes=('writes', 'mean'), calls=('calls', 'mean'),
+            p50=('total_ms', p50), p95=('total_ms', p95), db=('db_ms', 'mean'))
+        by_scope = by_scope.sort_values('reads', ascending=False).reset_index().rename(columns={
+            'name': 'Trang / job', 'n': 'Số lần', 'reads': 'Đọc TB', 'writes': 'Ghi TB', 'calls': 'Lệnh TB',
+            'p50': 'p50 (ms)', 'p95': 'p95 (ms)', 'db': 'Thời gian DB TB (ms)'})
+    return by_op, by_scope
 
 # ==========================================
-# 2. CÁC HÀM XỬ LÝ DATABASE (NO-SQL)
+# 2. CÁC HÀM XỬ LÝ DATABASE (FIRESTORE / SQL)
 # ==========================================
+# Mọi truy cập dữ liệu đi qua 1 "store" có cùng giao diện:
+# - FirestoreStore: mặc định, dùng Firebase như trước
+# - SqlStore: PostgreSQL / SQLite qua SQLAlchemy, bật bằng DATABASE_URL (env hoặc secrets["database_url"])
 
-def get_user_by_cccd(cccd):
-    # Tìm trong collection 'users'
-    docs = db.collection('users').where('so_cccd', '==', cccd).stream()
-    for doc in docs:
+# Mật khẩu mặc định không hash riêng cho từng user: chỉ cần cờ 'must_change_password'.
+# Hash thật (PBKDF2) chỉ chạy khi đăng nhập bằng mật khẩu riêng hoặc khi đổi mật khẩu.
+DEFAULT_PASSWORD = '123456'
+DEFAULT_CREDENTIALS = {'password_hash': None, 'must_change_password': True}
+
+def verify_password(user_data, password):
+    if user_data.get('must_change_password'):
+        return hmac.compare_digest(str(password).encode('utf-8'), DEFAULT_PASSWORD.encode('utf-8'))
+    pw_hash = user_data.get('password_hash')
+    return bool(pw_hash) and check_password_hash(pw_hash, password)
+
+# Bảng điểm tổng hợp: 1 document / học sinh trong 'report_cards', được cập nhật
+# cùng batch với 'scores'. 'scores'/'assessments' vẫn là dữ liệu gốc.
+# report_cards/{user_id} = {'user_id', 'complete', 'years': {nam_hoc: {'scores': {hoc_ky: {mon: {...}}}, 'assessment': {...}}}}
+# 'complete': card có đủ mọi kỳ. "Dựng lại" (rebuild) đặt cho mọi card rồi ghi mốc report_cards_meta/backfill;
+# từ đó mọi upload đều cập nhật card nên card upload ghi cũng có 'complete'. Trước mốc này card do upload
+# tạo có thể chỉ có các kỳ vừa upload -> đọc dữ liệu gốc.
+CARD_SCORE_FIELDS = ('mon_hoc', 'khoi', 'ddg_tx', 'ddg_gk', 'ddg_ck', 'dtb_mon')
+CARD_ASSESSMENT_FIELDS = ('kq_hoc_tap', 'kq_ren_luyen', 'danh_hieu', 'nhan_xet')
+
+# Thống kê theo khối: cohort_stats/{nam_hoc}_{hoc_ky}_{khoi}_{mon_hoc} giữ 'values' = {user_id: dtb_mon}
+# (ghi lại cùng giá trị không làm lệch số liệu) cùng các chỉ số tính sẵn; trang thống kê chỉ đọc phần tóm tắt.
+COHORT_SUMMARY_FIELDS = ('kind', 'nam_hoc', 'hoc_ky', 'khoi', 'mon_hoc', 'n', 'mean', 'median', 'pass_rate', 'hist', 'labels', 'counts')
+
+def _card_score(s):
+    return {k: s.get(k) for k in CARD_SCORE_FIELDS}
+
+def _card_assessment(a):
+    return {k: a.get(k) for k in CARD_ASSESSMENT_FIELDS}
+
+def _report_from_card(card):
+    scores, assessments = {}, {}
+    for nam_hoc, year in (card.get('years') or {}).items():
+        for hoc_ky, subjects in (year.get('scores') or {}).items():
+            # Sắp theo tên môn giống thứ tự document ID của 'scores'
+            scores[(nam_hoc, hoc_ky)] = [subjects[mon] for mon in sorted(subjects)]
+        if year.get('assessment'): assessments[nam_hoc] = year['assessment']
+    return {'scores': scores, 'assessments': assessments}
+
+def _group_report(score_rows, assessment_rows):
+    # Gom điểm theo (nam_hoc, hoc_ky), đánh giá theo nam_hoc (lấy bản đầu tiên)
+    scores, assessments = {}, {}
+    for s in score_rows:
+        scores.setdefault((s.get('nam_hoc'), s.get('hoc_ky')), []).append(s)
+    for a in assessment_rows:
+        assessments.setdefault(a.get('nam_hoc'), a)
+    return {'scores': scores, 'assessments': assessments}
+
+class FirestoreStore:
+    name = "firestore"
+
+    def __init__(self, client):
+        self.db = client
+
+    # ---------- Đo lường ----------
+    # Mọi lệnh đọc / ghi Firestore đi qua các hàm dưới -> số lệnh, số document, thời gian (tab "Hiệu năng")
+    def _get(self, ref, op, **kwargs):
+        t0 = time.perf_counter()
+        doc = ref.get(**kwargs)
+        perf_record(op, 'get', time.perf_counter() - t0, docs=int(doc.exists), reads=1)
+        return doc
+
+    def _stream(self, q, op):
+        # Thời gian tính đến khi duyệt hết kết quả; query không trả về document nào vẫn tính 1 lượt đọc
+        t0 = time.perf_counter(); n = 0
+        try:
+            for doc in q.stream():
+                n += 1
+                yield doc
+        finally:
+            perf_record(op, 'stream', time.perf_counter() - t0, docs=n, reads=max(n, 1))
+
+    def _commit(self, batch, op, writes):
+        t0 = time.perf_counter()
+        batch.commit()
+        perf_record(op, 'commit', time.perf_counter() - t0, writes=writes)
+
+    def _write(self, op, fn, *args):
+        t0 = time.perf_counter()
+        fn(*args)
+        perf_record(op, 'write', time.perf_counter() - t0, writes=1)
+
+    def _transaction(self, fn, op):
+        # fn trả về None khi không ghi gì
+        t0 = time.perf_counter()
+        result = fn(self.db.transaction())
+        perf_record(op, 'transaction', time.perf_counter() - t0, writes=int(result is not None))
+        return result
+
+    # ---------- Users ----------
+    # Document ID của user = số CCCD -> đăng nhập chỉ cần 1 lần document(cccd).get().
+    # User cũ (ID tự sinh) sau khi migrate giữ ID cũ trong field 'user_id' để khớp scores.user_id.
+    @staticmethod
+    def _is_doc_id(val):
+        return bool(val) and '/' not in val and val not in ('.', '..')
+
+    @staticmethod
+    def _user_from_doc(doc):
         data = doc.to_dict()
-        data['id'] = doc.id # Lưu ID tài liệu để update
+        data['doc_id'] = doc.id # ID tài liệu để update
+        data['id'] = data.get('user_id') or doc.id # ID dùng cho scores.user_id
         return data
-    return None
+
+    def _new_user_ref(self, cccd):
+        return self.db.collection('users').document(cccd if self._is_doc_id(cccd) else None)
+
+    def get_user_by_cccd(self, cccd):
+        if self._is_doc_id(cccd):
+            doc = self._get(self.db.collection('users').document(cccd), 'get_user_by_cccd')
+            if doc.exists: return self._user_from_doc(doc)
+        # Dữ liệu chưa migrate: tìm theo field
+        for doc in self._stream(self.db.collection('users').where('so_cccd', '==', cccd).limit(1), 'get_user_by_cccd'):
+            return self._user_from_doc(doc)
+        return None
+
+    def create_user(self, data):
+        ref = self._new_user_ref(data['so_cccd'])
+        self._write('create_user', ref.set, {'user_id': data.get('user_id') or ref.id, **data})
+        return ref.id
+
+    def update_user(self, doc_id, updates):
+        self._write('update_user', self.db.collection('users').document(doc_id).update, updates)
+
+    def write_users(self, creates, updates, chunk_size=400, on_progress=None):
+        # creates: [data, ...], updates: {doc_id: {...}} -> ghi batch theo từng chunk
+        ops = []
+        for data in creates:
+            ref = self._new_user_ref(data['so_cccd'])
+            ops.append((ref, 'set', {'user_id': ref.id, **data}))
+        ops += [(self.db.collection('users').document(doc_id), 'update', upd) for doc_id, upd in updates.items()]
+        for start in range(0, len(ops), chunk_size):
+            batch = self.db.batch()
+            chunk = ops[start:start + chunk_size]
+            for ref, op, data in chunk:
+                getattr(batch, op)(ref, data)
+            self._commit(batch, 'write_users', len(chunk))
+            if on_progress: on_progress(min(start + chunk_size, len(ops)), len(ops))
+
+    def consume_login(self, user_data):
+        ref = self.db.collection('users').document(user_data['doc_id'])
+
+        @firestore.transactional
+        def _consume(transaction):
+            c = int(self._get(ref, 'consume_login', transaction=transaction).get('login_status'))
+            if c <= 0: return None
+            transaction.update(ref, {'login_status': str(c - 1)})
+            return c - 1
+        return self._transaction(_consume, 'consume_login')
+
+    def user_keys(self):
+        # so_cccd -> {id, ma_hs, nien_khoa}, chỉ lấy 3 field (projection)
+        keys = {}
+        for doc in self._stream(self.db.collection('users').select(['so_cccd', 'ma_hs', 'nien_khoa']), 'user_keys'):
+            u = doc.to_dict()
+            keys.setdefault(u.get('so_cccd'), {'id': doc.id, 'ma_hs': u.get('ma_hs'), 'nien_khoa': u.get('nien_khoa')})
+        return keys
+
+    def student_index(self):
+        index = {}
+        for doc in self._stream(self.db.collection('users').select(['ma_hs', 'nien_khoa', 'user_id']), 'student_index'):
+            u = doc.to_dict()
+            if u.get('ma_hs'): index[u['ma_hs']] = (u.get('user_id') or doc.id, u.get('nien_khoa'))
+        return index
+
+    def user_directory(self, nien_khoa=None):
+        # user_id -> {ma_hs, ho_ten, nien_khoa} cho xuất dữ liệu
+        q = self.db.collection('users')
+        if nien_khoa: q = q.where('nien_khoa', '==', nien_khoa)
+        directory = {}
+        for doc in self._stream(q.select(['user_id', 'ma_hs', 'ho_ten', 'nien_khoa']), 'user_directory'):
+            u = doc.to_dict()
+            directory[u.pop('user_id', None) or doc.id] = u
+        return directory
+
+    def list_users_page(self, page_size=100, cursor=None, ma_hs=None, ho_ten=None, nien_khoa=None):
+        # Mọi truy vấn ở đây (kể cả không lọc) cần composite index trong firestore.indexes.json:
+        # (is_admin, ma_hs), (is_admin, ho_ten), (is_admin, nien_khoa, ma_hs), (is_admin, nien_khoa, ho_ten)
+        q = self.db.collection('users').where('is_admin', '==', False)
+        if nien_khoa: q = q.where('nien_khoa', '==', nien_khoa)
+        order_field, prefix = ('ho_ten', ho_ten) if ho_ten and not ma_hs else ('ma_hs', ma_hs)
+        if prefix:
+            q = q.where(order_field, '>=', prefix).where(order_field, '<', prefix + '\uf8ff')
+        q = q.order_by(order_field)
+        if cursor is not None: q = q.start_after(cursor)
+        docs = list(self._stream(q.limit(page_size + 1), 'list_users_page'))
+        has_more = len(docs) > page_size
+        docs = docs[:page_size]
+        return [self._user_from_doc(d) for d in docs], (docs[-1] if has_more else None)
+
+    def update_users(self, changes):
+        items = list(changes.items())
+        for start in range(0, len(items), 400):
+            batch = self.db.batch()
+            chunk = items[start:start + 400]
+            for doc_id, updates in chunk:
+                batch.update(self.db.collection('users').document(doc_id), updates)
+            self._commit(batch, 'update_users', len(chunk))
+
+    def migrate_users_to_cccd_keys(self):
+        docs = list(self._stream(self.db.collection('users'), 'migrate_users'))
+        taken = {doc.id for doc in docs}
+        moved = skipped = 0
+        batch = self.db.batch(); batch_count = 0
+        for doc in docs:
+            u = doc.to_dict()
+            cccd = u.get('so_cccd')
+            if doc.id == cccd: continue
+            if not self._is_doc_id(cccd) or cccd in taken:
+                skipped += 1; continue
+            taken.add(cccd)
+            u['user_id'] = u.get('user_id') or doc.id
+            batch.set(self.db.collection('users').document(cccd), u)
+            batch.delete(self.db.collection('users').document(doc.id))
+            batch_count += 2; moved += 1
+            if batch_count >= 400:
+                self._commit(batch, 'migrate_users', batch_count); batch = self.db.batch(); batch_count = 0
+        self._commit(batch, 'migrate_users', batch_count)
+        return moved, skipped
+
+    # ---------- Scores ----------
+    def get_scores(self, user_id, nam_hoc, hoc_ky):
+        # Tìm điểm theo user_id (là document ID của user trong firebase)
+        q = self.db.collection('scores').where('user_id', '==', user_id)\
+              .where('nam_hoc', '==', nam_hoc)\
+              .where('hoc_ky', '==', hoc_ky)
+        return [doc.to_dict() for doc in self._stream(q, 'get_scores')]
+
+    def get_assessment(self, user_id, nam_hoc):
+        q = self.db.collection('assessments').where('user_id', '==', user_id)\
+              .where('nam_hoc', '==', nam_hoc)
+        for doc in self._stream(q, 'get_assessment'):
+            return doc.to_dict()
+        return None
+
+    def load_student_report(self, user_id):
+        card = self._get(self.db.collection('report_cards').document(user_id), 'load_student_report')
+        card = card.to_dict() if card.exists else None
+        if card and card.get('complete'): return _report_from_card(card)
+        # Chưa có bảng tổng hợp đầy đủ (chưa backfill, card chỉ có các kỳ upload sau) -> đọc thẳng dữ liệu gốc
+        return _group_report(
+            [doc.to_dict() for doc in self._stream(self.db.collection('scores').where('user_id', '==', user_id), 'load_student_report')],
+            [doc.to_dict() for doc in self._stream(self.db.collection('assessments').where('user_id', '==', user_id), 'load_student_report')])
+
+    def rebuild_report_cards(self):
+        cards = {}
+        for doc in self._stream(self.db.collection('scores'), 'rebuild_report_cards'):
+            s = doc.to_dict()
+            year = cards.setdefault(s.get('user_id'), {}).setdefault(s.get('nam_hoc'), {})
+            year.setdefault('scores', {}).setdefault(s.get('hoc_ky'), {})[s.get('mon_hoc')] = _card_score(s)
+        for doc in self._stream(self.db.collection('assessments'), 'rebuild_report_cards'):
+            a = doc.to_dict()
+            year = cards.setdefault(a.get('user_id'), {}).setdefault(a.get('nam_hoc'), {})
+            year.setdefault('assessment', _card_assessment(a))
+
+        batch = self.db.batch(); batch_count = 0
+        for user_id, years in cards.items():
+            if not user_id: continue
+            batch.set(self.db.collection('report_cards').document(user_id), {'user_id': user_id, 'complete': True, 'years': years})
+            batch_count += 1
+            if batch_count >= 400:
+                self._commit(batch, 'rebuild_report_cards', batch_count); batch = self.db.batch(); batch_count = 0
+        self._commit(batch, 'rebuild_report_cards', batch_count)
+        self._write('rebuild_report_cards', self.db.collection('report_cards_meta').document('backfill').set,
+                    {'done_at': firestore.SERVER_TIMESTAMP, 'cards': len(cards)})
+        return set(cards)
+
+    def report_cards_backfilled(self):
+        return self._get(self.db.collection('report_cards_meta').document('backfill'), 'report_cards_backfilled').exists
+
+    def load_existing_results(self, nam_hoc, hoc_ky):
+        existing = {}
+        for doc in self._stream(self.db.collection('scores').where('nam_hoc', '==', nam_hoc).where('hoc_ky', '==', hoc_ky), 'load_existing_results'):
+            existing[('scores', doc.id)] = doc.to_dict()
+        if hoc_ky == "CaNam":
+            for doc in self._stream(self.db.collection('assessments').where('nam_hoc', '==', nam_hoc), 'load_existing_results'):
+                existing[('assessments', doc.id)] = doc.to_dict()
+        return existing
+
+    def iter_results(self, collection, nam_hoc, hoc_ky=None, fields=None, page_size=1000):
+        # Duyệt scores/assessments theo trang (thứ tự document ID, tức là theo user_id)
+        q = self.db.collection(collection).where('nam_hoc', '==', nam_hoc)
+        if hoc_ky: q = q.where('hoc_ky', '==', hoc_ky)
+        if fields: q = q.select(fields)
+        q = q.order_by('__name__').limit(page_size)
+        cursor = None
+        while True:
+            docs = list(self._stream(q if cursor is None else q.start_after(cursor), f'iter_results:{collection}'))
+            if docs: yield [doc.to_dict() for doc in docs]
+            if len(docs) < page_size: return
+            cursor = docs[-1]
+
+    def commit_writes(self, ops):
+        batch = self.db.batch()
+        for collection, doc_id, data, merge in ops:
+            ref = self.db.collection(collection).document(doc_id)
+            if merge: batch.set(ref, data, merge=True)
+            else: batch.set(ref, data)
+        self._commit(batch, 'commit_writes', len(ops))
+        return len(ops)
+
+    # Lần upload mới nhất của từng kỳ: last_uploads/{nam_hoc}_{hoc_ky}
+    def last_upload(self, nam_hoc, hoc_ky):
+        doc = self._get(self.db.collection('last_uploads').document(f"{nam_hoc}_{hoc_ky}"), 'last_upload')
+        return doc.to_dict() if doc.exists else None
+
+    def record_upload(self, nam_hoc, hoc_ky, fingerprint, name, index_hash, students_updated):
+        self._write('record_upload', self.db.collection('last_uploads').document(f"{nam_hoc}_{hoc_ky}").set, {
+            'nam_hoc': nam_hoc, 'hoc_ky': hoc_ky, 'fingerprint': fingerprint, 'file_name': name,
+            'index_hash': index_hash, 'students': students_updated, 'uploaded_at': firestore.SERVER_TIMESTAMP
+        })
+
+    # ---------- Thống kê khối ----------
+    def update_cohort_doc(self, doc_id, merge):
+        # Đọc - gộp - ghi trong transaction: nhiều file / job có thể cập nhật cùng 1 document
+        ref = self.db.collection('cohort_stats').document(doc_id)
+
+        @firestore.transactional
+        def _update(transaction):
+            old = self._get(ref, 'update_cohort_doc', transaction=transaction)
+            doc = merge(old.to_dict() if old.exists else None)
+            if doc is not None: transaction.set(ref, doc)
+            return doc
+        self._transaction(_update, 'update_cohort_doc')
+
+    def load_cohort_stats(self, nam_hoc, hoc_ky):
+        q = self.db.collection('cohort_stats').where('nam_hoc', '==', nam_hoc).where('hoc_ky', '==', hoc_ky)
+        return [doc.to_dict() for doc in self._stream(q.select(list(COHORT_SUMMARY_FIELDS)), 'load_cohort_stats')]
+
+class SqlStore:
+    """Lưu trữ SQL (PostgreSQL / SQLite), cùng giao diện với FirestoreStore.
+
+    users có khóa chính so_cccd; scores/assessments giữ đúng document ID như
+    Firestore và có composite index (user_id, nam_hoc, hoc_ky). Ingest dùng
+    bulk upsert (INSERT ... ON CONFLICT DO UPDATE). Không cần report_cards:
+    bảng điểm 1 học sinh là 1 truy vấn theo index.
+    """
+    name = "sql"
+
+    def __init__(self, url):
+        kwargs = {}
+        if url.startswith('sqlite'):
+            # Cho phép dùng chung từ thread nền; SQLite trong RAM phải dùng 1 connection duy nhất
+            kwargs['connect_args'] = {'check_same_thread': False}
+            if url in ('sqlite://', 'sqlite:///:memory:'): kwargs['poolclass'] = sa.pool.StaticPool
+        self.engine = sa.create_engine(url, **kwargs)
+        self._lock = threading.RLock() if url.startswith('sqlite') else contextlib.nullcontext()
+        if self.engine.dialect.name not in ('postgresql', 'sqlite'):
+            raise ValueError(f"Chưa hỗ trợ database '{self.engine.dialect.name}' (chỉ PostgreSQL / SQLite).")
+        meta = sa.MetaData()
+        text = sa.String
+        self.users = sa.Table(
+            'users', meta,
+            sa.Column('so_cccd', text, primary_key=True),
+            sa.Column('user_id', text, nullable=False, unique=True),
+            sa.Column('ma_hs', text, index=True),
+            sa.Column('ho_ten', text),
+            sa.Column('nien_khoa', text, index=True),
+            sa.Column('login_status', text),
+            sa.Column('is_admin', sa.Boolean, nullable=False, default=False),
+            sa.Column('password_hash', text),
+            sa.Column('must_change_password', sa.Boolean),
+        )
+        self.scores = sa.Table(
+            'scores', meta,
+            sa.Column('id', text, primary_key=True),
+            sa.Column('user_id', text, nullable=False),
+            sa.Column('mon_hoc', text),
+            sa.Column('nam_hoc', text),
+            sa.Column('hoc_ky', text),
+            sa.Column('khoi', sa.Integer),
+            sa.Column('ddg_tx', text), sa.Column('ddg_gk', text), sa.Column('ddg_ck', text), sa.Column('dtb_mon', text),
+            sa.Index('ix_scores_user_nam_hk', 'user_id', 'nam_hoc', 'hoc_ky'),
+            sa.Index('ix_scores_nam_hk', 'nam_hoc', 'hoc_ky'),
+        )
+        self.assessments = sa.Table(
+            'assessments', meta,
+            sa.Column('id', text, primary_key=True),
+            sa.Column('user_id', text, nullable=False),
+            sa.Column('nam_hoc', text),
+            sa.Column('kq_hoc_tap', text), sa.Column('kq_ren_luyen', text),
+            sa.Column('danh_hieu', text), sa.Column('nhan_xet', text),
+            sa.Index('ix_assessments_user_nam', 'user_id', 'nam_hoc'),
+            sa.Index('ix_assessments_nam', 'nam_hoc'),
+        )
+        self.uploads = sa.Table(
+            'last_uploads', meta,
+            sa.Column('nam_hoc', text, primary_key=True),
+            sa.Column('hoc_ky', text, primary_key=True),
+            sa.Column('fingerprint', text),
+            sa.Column('file_name', text),
+            sa.Column('index_hash', text),
+            sa.Column('students', sa.Integer),
+            sa.Column('uploaded_at', sa.DateTime(timezone=True), server_default=sa.func.now()),
+        )
+        self.cohort = sa.Table(
+            'cohort_stats', meta,
+            sa.Column('id', text, primary_key=True),
+            sa.Column('nam_hoc', text), sa.Column('hoc_ky', text),
+            sa.Column('data', sa.JSON),
+            sa.Index('ix_cohort_nam_hk', 'nam_hoc', 'hoc_ky'),
+        )
+        meta.create_all(self.engine)
+
+    # SQLite chỉ cho 1 writer (và RAM dùng chung 1 connection) -> tuần tự hóa truy cập giữa các thread
+    @contextlib.contextmanager
+    def _connect(self):
+        with self._lock, self.engine.connect() as conn:
+            yield conn
+
+    @contextlib.contextmanager
+    def _begin(self):
+        with self._lock, self.engine.begin() as conn:
+            yield conn
+
+    @staticmethod
+    def _row(row, drop=()):
+        return {k: v for k, v in row._mapping.items() if k not in drop}
+
+    def _user(self, row):
+        data = self._row(row)
+        data['doc_id'] = data['so_cccd']
+        data['id'] = data.get('user_id') or data['so_cccd']
+        return data
+
+    def _upsert(self, conn, table, rows):
+        if not rows: return
+        insert = pg_insert if self.engine.dialect.name == 'postgresql' else sqlite_insert
+        stmt = insert(table)
+        pk = [c.name for c in table.primary_key]
+        stmt = stmt.on_conflict_do_update(
+            index_elements=pk, set_={c.name: stmt.excluded[c.name] for c in table.columns if c.name not in pk})
+        conn.execute(stmt, rows)
+
+    def _update_many(self, conn, changes):
+        # Gom các update cùng tập cột -> 1 lệnh executemany
+        by_cols = {}
+        for doc_id, upd in changes.items():
+            by_cols.setdefault(tuple(sorted(upd)), []).append({'_id': doc_id, **upd})
+        for cols, rows in by_cols.items():
+            stmt = sa.update(self.users).where(self.users.c.so_cccd == sa.bindparam('_id'))\
+                     .values({c: sa.bindparam(c) for c in cols})
+            conn.execute(stmt, rows)
+
+    # ---------- Users ----------
+    def get_user_by_cccd(self, cccd):
+        with self._connect() as conn:
+            row = conn.execute(sa.select(self.users).where(self.users.c.so_cccd == cccd)).first()
+        return self._user(row) if row else None
+
+    def create_user(self, data):
+        with self._begin() as conn:
+            conn.execute(sa.insert(self.users), [{'user_id': data.get('user_id') or data['so_cccd'], **data}])
+        return data['so_cccd']
+
+    def update_user(self, doc_id, updates):
+        with self._begin() as conn:
+            conn.execute(sa.update(self.users).where(self.users.c.so_cccd == doc_id).values(updates))
+
+    def write_users(self, creates, updates, chunk_size=400, on_progress=None):
+        total = len(creates) + len(updates)
+        with self._begin() as conn:
+            for start in range(0, len(creates), chunk_size):
+                rows = [{'user_id': d['so_cccd'], **d} for d in creates[start:start + chunk_size]]
+                conn.execute(sa.insert(self.users), rows)
+                if on_progress: on_progress(start + len(rows), total)
+            self._update_many(conn, updates)
+        if on_progress and total: on_progress(total, total)
+
+    def consume_login(self, user_data):
+        with self._begin() as conn:
+            c = int(conn.execute(sa.select(self.users.c.login_status)
+                                   .where(self.users.c.so_cccd == user_data['doc_id'])
+                                   .with_for_update()).scalar_one())
+            if c <= 0: return None
+            conn.execute(sa.update(self.users).where(self.users.c.so_cccd == user_data['doc_id'])
+                           .values(login_status=str(c - 1)))
+        return c - 1
+
+    def user_keys(self):
+        u = self.users
+        with self._connect() as conn:
+            rows = conn.execute(sa.select(u.c.so_cccd, u.c.ma_hs, u.c.nien_khoa)).all()
+        return {r.so_cccd: {'id': r.so_cccd, 'ma_hs': r.ma_hs, 'nien_khoa': r.nien_khoa} for r in rows}
+
+    def student_index(self):
+        u = self.users
+        with self._connect() as conn:
+            rows = conn.execute(sa.select(u.c.ma_hs, u.c.user_id, u.c.nien_khoa)
+                                  .where(u.c.ma_hs.is_not(None)).order_by(u.c.so_cccd)).all()
+        return {r.ma_hs: (r.user_id, r.nien_khoa) for r in rows if r.ma_hs}
+
+    def user_directory(self, nien_khoa=None):
+        u = self.users
+        q = sa.select(u.c.user_id, u.c.ma_hs, u.c.ho_ten, u.c.nien_khoa)
+        if nien_khoa: q = q.where(u.c.nien_khoa == nien_khoa)
+        with self._connect() as conn:
+            return {r.user_id: {'ma_hs': r.ma_hs, 'ho_ten': r.ho_ten, 'nien_khoa': r.nien_khoa} for r in conn.execute(q)}
+
+    def list_users_page(self, page_size=100, cursor=None, ma_hs=None, ho_ten=None, nien_khoa=None):
+        u = self.users
+        order_col, prefix = (u.c.ho_ten, ho_ten) if ho_ten and not ma_hs else (u.c.ma_hs, ma_hs)
+        q = sa.select(u).where(u.c.is_admin == sa.false())
+        if nien_khoa: q = q.where(u.c.nien_khoa == nien_khoa)
+        if prefix: q = q.where(order_col.startswith(prefix, autoescape=True))
+        if cursor is not None:
+            # cursor = (giá trị cột sắp xếp, so_cccd) của dòng cuối trang trước
+            q = q.where(sa.or_(order_col > cursor[0], sa.and_(order_col == cursor[0], u.c.so_cccd > cursor[1])))
+        q = q.order_by(order_col, u.c.so_cccd).limit(page_size + 1)
+        with self._connect() as conn:
+            users = [self._user(r) for r in conn.execute(q)]
+        has_more = len(users) > page_size
+        users = users[:page_size]
+        last = users[-1] if users else None
+        return users, ((last[order_col.name], last['so_cccd']) if has_more else None)
+
+    def update_users(self, changes):
+        with self._begin() as conn:
+            self._update_many(conn, changes)
+
+    def migrate_users_to_cccd_keys(self):
+        return 0, 0 # Bảng users đã dùng CCCD làm khóa chính
+
+    # ---------- Scores ----------
+    def get_scores(self, user_id, nam_hoc, hoc_ky):
+        s = self.scores
+        with self._connect() as conn:
+            rows = conn.execute(sa.select(s).where(s.c.user_id == user_id, s.c.nam_hoc == nam_hoc, s.c.hoc_ky == hoc_ky)
+                                  .order_by(s.c.id)).all()
+        return [self._row(r, drop=('id',)) for r in rows]
+
+    def get_assessment(self, user_id, nam_hoc):
+        a = self.assessments
+        with self._connect() as conn:
+            row = conn.execute(sa.select(a).where(a.c.user_id == user_id, a.c.nam_hoc == nam_hoc)
+                                 .order_by(a.c.id).limit(1)).first()
+        return self._row(row, drop=('id',)) if row else None
+
+    def load_student_report(self, user_id):
+        s, a = self.scores, self.assessments
+        with self._connect() as conn:
+            score_rows = conn.execute(sa.select(s).where(s.c.user_id == user_id).order_by(s.c.id)).all()
+            ass_rows = conn.execute(sa.select(a).where(a.c.user_id == user_id).order_by(a.c.id)).all()
+        return _group_report((self._row(r, drop=('id',)) for r in score_rows),
+                             (self._row(r, drop=('id',)) for r in ass_rows))
+
+    def rebuild_report_cards(self):
+        return set() # Không có bảng tổng hợp riêng
+
+    def report_cards_backfilled(self):
+        return False
+
+    def load_existing_results(self, nam_hoc, hoc_ky):
+        s, a = self.scores, self.assessments
+        existing = {}
+        with self._connect() as conn:
+            for r in conn.execute(sa.select(s).where(s.c.nam_hoc == nam_hoc, s.c.hoc_ky == hoc_ky)):
+                existing[('scores', r.id)] = self._row(r, drop=('id',))
+            if hoc_ky == "CaNam":
+                for r in conn.execute(sa.select(a).where(a.c.nam_hoc == nam_hoc)):
+                    existing[('assessments', r.id)] = self._row(r, drop=('id',))
+        return existing
+
+    def iter_results(self, collection, nam_hoc, hoc_ky=None, fields=None, page_size=1000):
+        # Keyset pagination theo id (cùng thứ tự với Firestore)
+        t = self.scores if collection == 'scores' else self.assessments
+        cols = [t.c[f] for f in fields] if fields else [c for c in t.c if c.name != 'id']
+        q = sa.select(t.c.id, *cols).where(t.c.nam_hoc == nam_hoc)
+        if hoc_ky: q = q.where(t.c.hoc_ky == hoc_ky)
+        q = q.order_by(t.c.id).limit(page_size)
+        last = None
+        while True:
+            with self._connect() as conn:
+                rows = conn.execute(q if last is None else q.where(t.c.id > last)).all()
+            if rows: yield [self._row(r, drop=('id',)) for r in rows]
+            if len(rows) < page_size: return
+            last = rows[-1].id
+
+    def commit_writes(self, ops):
+        # Bulk upsert theo bảng; document trùng ID trong cùng lô -> giữ bản sau cùng như Firestore
+        rows = {'scores': {}, 'assessments': {}}
+        for collection, doc_id, data, merge in ops:
+            if collection in rows: rows[collection][doc_id] = {'id': doc_id, **data}
+        with self._begin() as conn:
+            self._upsert(conn, self.scores, list(rows['scores'].values()))
+            self._upsert(conn, self.assessments, list(rows['assessments'].values()))
+        return len(ops)
+
+    def last_upload(self, nam_hoc, hoc_ky):
+        up = self.uploads
+        with self._connect() as conn:
+            row = conn.execute(sa.select(up.c.fingerprint, up.c.index_hash)
+                                 .where(up.c.nam_hoc == nam_hoc, up.c.hoc_ky == hoc_ky)).first()
+        return dict(row._mapping) if row else None
+
+    def record_upload(self, nam_hoc, hoc_ky, fingerprint, name, index_hash, students_updated):
+        with self._begin() as conn:
+            self._upsert(conn, self.uploads, [{'nam_hoc': nam_hoc, 'hoc_ky': hoc_ky, 'fingerprint': fingerprint, 'file_name': name,
+                                               'index_hash': index_hash, 'students': students_updated}])
+
+    def update_cohort_doc(self, doc_id, merge):
+        c = self.cohort
+        with self._begin() as conn:
+            old = conn.execute(sa.select(c.c.data).where(c.c.id == doc_id).with_for_update()).scalar()
+            doc = merge(old)
+            if doc is not None:
+                self._upsert(conn, c, [{'id': doc_id, 'nam_hoc': doc['nam_hoc'], 'hoc_ky': doc['hoc_ky'], 'data': doc}])
+
+    def load_cohort_stats(self, nam_hoc, hoc_ky):
+        c = self.cohort
+        with self._connect() as conn:
+            docs = conn.execute(sa.select(c.c.data).where(c.c.nam_hoc == nam_hoc, c.c.hoc_ky == hoc_ky)).scalars().all()
+        return [{k: d[k] for k in COHORT_SUMMARY_FIELDS if k in d} for d in docs]
+
+def _database_url():
+    url = os.environ.get('DATABASE_URL')
+    if url: return url
+    try: return st.secrets.get('database_url')
+    except Exception: return None # Chưa có secrets.toml
+
+@st.cache_resource(show_spinner=False)
+def get_store():
+    url = _database_url()
+    return SqlStore(url) if url else FirestoreStore(get_db())
+
+store = get_store()
+
+def get_user_by_cccd(cccd):
+    return store.get_user_by_cccd(cccd)
+
+def consume_login(user_data):
+    """Trừ 1 lượt đăng nhập trong transaction. Trả về số lượt còn lại, None nếu đã hết."""
+    return store.consume_login(user_data)
+
+def migrate_users_to_cccd_keys():
+    """Chuyển user có ID tự sinh sang document ID = CCCD (giữ ID cũ trong 'user_id').
+
+    CCCD trùng hoặc không hợp lệ được bỏ qua. Trả về (số user đã chuyển, số bỏ qua).
+    """
+    return store.migrate_users_to_cccd_keys()
 
 def create_or_update_user(cccd, ma_hs, ho_ten, nien_khoa, status="5"):
     existing = get_user_by_cccd(cccd)
     if existing:
         # Update
-        db.collection('users').document(existing['id']).update({
+        store.update_user(existing['doc_id'], {
             'ma_hs': ma_hs,
             'nien_khoa': nien_khoa
             # Không update password hay status để tránh reset quyền
@@ -42,66 +766,175 @@ def create_or_update_user(cccd, ma_hs, ho_ten, nien_khoa, status="5"):
         return False # Không tạo mới
     else:
         # Create
-        data = {
+        store.create_user({
             'so_cccd': cccd,
             'ma_hs': ma_hs,
             'ho_ten': ho_ten,
             'nien_khoa': nien_khoa,
             'login_status': status,
             'is_admin': False,
-            'password_hash': generate_password_hash('123456')
-        }
-        db.collection('users').add(data)
+            **DEFAULT_CREDENTIALS
+        })
         return True # Đã tạo mới
 
+def bulk_import_users(rows, chunk_size=400):
+    """Import hàng loạt user: rows = [(cccd, ma_hs, ho_ten, nien_khoa), ...].
+
+    Đọc toàn bộ CCCD hiện có 1 lần, so sánh với file rồi ghi tạo mới / cập nhật
+    bằng batch theo từng chunk. Trả về dict số lượng created/updated/unchanged.
+    """
+    existing = store.user_keys()
+
+    creates, updates, unchanged = {}, {}, set()
+    for cccd, ma_hs, ho_ten, nien_khoa in rows:
+        if cccd in creates:
+            # CCCD lặp lại trong file: dòng sau chỉ cập nhật ma_hs/nien_khoa như create_or_update_user
+            creates[cccd].update({'ma_hs': ma_hs, 'nien_khoa': nien_khoa})
+            continue
+        cur = existing.get(cccd)
+        if cur is None:
+            creates[cccd] = {
+                'so_cccd': cccd,
+                'ma_hs': ma_hs,
+                'ho_ten': ho_ten,
+                'nien_khoa': nien_khoa,
+                'login_status': "5",
+                'is_admin': False,
+                **DEFAULT_CREDENTIALS
+            }
+        elif cur['ma_hs'] == ma_hs and cur['nien_khoa'] == nien_khoa:
+            unchanged.add(cur['id'])
+        else:
+            # Không update password hay status để tránh reset quyền
+            cur.update({'ma_hs': ma_hs, 'nien_khoa': nien_khoa})
+            updates[cur['id']] = {'ma_hs': ma_hs, 'nien_khoa': nien_khoa}
+
+    progress = st.progress(0)
+    store.write_users(list(creates.values()), updates, chunk_size,
+                      on_progress=lambda done, total: progress.progress(min(done / total, 1.0)))
+    progress.empty()
+    return {'created': len(creates), 'updated': len(updates), 'unchanged': len(unchanged - set(updates))}
+
 def get_scores(user_id, nam_hoc, hoc_ky):
-    # Tìm điểm theo user_id (là document ID của user trong firebase)
-    docs = db.collection('scores').where('user_id', '==', user_id)\
-             .where('nam_hoc', '==', nam_hoc)\
-             .where('hoc_ky', '==', hoc_ky).stream()
-    
-    results = []
-    for doc in docs:
-        results.append(doc.to_dict())
-    return results
+    return store.get_scores(user_id, nam_hoc, hoc_ky)
 
 def get_assessment(user_id, nam_hoc):
-    docs = db.collection('assessments').where('user_id', '==', user_id)\
-             .where('nam_hoc', '==', nam_hoc).stream()
-    for doc in docs:
-        return doc.to_dict()
-    return None
-
-# Tạo Admin mặc định nếu chưa có
-admin_check = db.collection('users').where('so_cccd', '==', 'admin').get()
-if not admin_check:
-    db.collection('users').add({
-        'so_cccd': 'admin',
-        'ho_ten': 'Quản Trị Viên',
-        'is_admin': True,
-        'nien_khoa': 'System',
-        'login_status': 'full',
-        'password_hash': generate_password_hash('admin123')
-    })
+    return store.get_assessment(user_id, nam_hoc)
+
+# Cache bảng điểm của học sinh: mỗi lần rerun không phải query lại database.
+# Version theo user -> upload điểm mới chỉ cần tăng version là cache cũ hết hiệu lực.
+@st.cache_resource
+def _report_versions():
+    return {}
+
+@st.cache_data(ttl=600, max_entries=5000, show_spinner=False)
+def _load_student_report(user_id, version):
+    return store.load_student_report(user_id)
+
+def get_student_report(user_id):
+    """Toàn bộ điểm + đánh giá của 1 học sinh (1 lần đọc report_cards), nhóm theo (nam_hoc, hoc_ky)."""
+    return _load_student_report(user_id, _report_versions().get(user_id, 0))
+
+def invalidate_student_report(user_ids):
+    versions = _report_versions()
+    for user_id in user_ids:
+        versions[user_id] = versions.get(user_id, 0) + 1
+
+@st.cache_data(ttl=600, max_entries=200, show_spinner=False)
+def _load_cohort_stats(nam_hoc, hoc_ky, version):
+    return store.load_cohort_stats(nam_hoc, hoc_ky)
+
+def get_cohort_stats(nam_hoc, hoc_ky):
+    """Tóm tắt thống kê mọi khối / môn của 1 kỳ (cache dùng chung cho mọi phiên)."""
+    return _load_cohort_stats(nam_hoc, hoc_ky, _report_versions().get(('cohort', nam_hoc, hoc_ky), 0))
+
+def rebuild_report_cards():
+    """Dựng lại toàn bộ report_cards từ scores/assessments (dùng để backfill)."""
+    user_ids = store.rebuild_report_cards()
+    invalidate_student_report(user_ids)
+    return len(user_ids)
+
+def report_cards_backfilled():
+    # Đã "Dựng lại" ít nhất 1 lần -> card do upload ghi là đầy đủ (không đọc được -> coi như chưa)
+    try: return store.report_cards_backfilled()
+    except Exception: return False
+
+def list_users_page(page_size=100, cursor=None, ma_hs=None, ho_ten=None, nien_khoa=None):
+    """1 trang user (không phải admin), phân trang bằng cursor.
+
+    Lọc theo tiền tố ma_hs hoặc ho_ten (ưu tiên ma_hs) và niên khóa chính xác.
+    Trả về (danh sách user, cursor trang sau hoặc None).
+    """
+    return store.list_users_page(page_size, cursor, ma_hs, ho_ten, nien_khoa)
+
+def diff_user_changes(before, after):
+    """So sánh bảng user trước/sau khi sửa -> {doc_id: updates}, chỉ các dòng thực sự đổi."""
+    merged = after.merge(before[['ID', 'Full Access']], on='ID', suffixes=('', '_old'))
+    changed = merged[(merged['Full Access'] != merged['Full Access_old']) | merged['Reset Pass']]
+    changes = {}
+    for row in changed.to_dict('records'):
+        updates = {}
+        # Logic Full
+        if row['Full Access'] != row['Full Access_old']:
+            updates['login_status'] = 'full' if row['Full Access'] else '5'
+        # Logic Reset
+        if row['Reset Pass']: updates.update(DEFAULT_CREDENTIALS)
+        changes[row['ID']] = updates
+    return changes
+
+def save_user_changes(changes):
+    store.update_users(changes)
+    return len(changes)
+
+@st.cache_resource(show_spinner=False)
+def bootstrap():
+    """Chạy 1 lần / process: kiểm tra kết nối + tạo Admin mặc định nếu chưa có.
+
+    Lỗi không được cache (lần rerun sau sẽ thử lại). Trả về dict trạng thái.
+    """
+    t0 = time.perf_counter()
+    admin_seeded = False
+    if not get_user_by_cccd('admin'):
+        store.create_user({
+            'user_id': 'admin',
+            'so_cccd': 'admin',
+            'ho_ten': 'Quản Trị Viên',
+            'is_admin': True,
+            'nien_khoa': 'System',
+            'login_status': 'full',
+            'password_hash': generate_password_hash('admin123')
+        })
+        admin_seeded = True
+    return {'ready': True, 'backend': store.name, 'started_at': time.time(),
+            'boot_seconds': time.perf_counter() - t0, 'admin_seeded': admin_seeded}
+
+def health_status():
+    # Trạng thái sẵn sàng của app (không tốn thêm lần đọc database sau khi bootstrap xong)
+    try:
+        return {**bootstrap(), 'error': None}
+    except Exception as e:
+        return {'ready': False, 'error': str(e)}
 
 # ==========================================
 # 3. XỬ LÝ FILE EXCEL (AUTO PARSER)
 # ==========================================
 
-def clean_str(val):
-    if pd.isna(val) or str(val).strip() == '': return None
-    s = str(val).strip()
-    return s.replace('.0', '') if s.endswith('.0') and len(s) > 2 else s
+def parse_user_sheet(df):
+    # File user -> [(cccd, ma_hs, ho_ten, nien_khoa), ...]
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    col_map = {}
+    for c in df.columns:
+        if "cccd" in c: col_map['cccd'] = c
+        if "mã" in c or "ma_hs" in c: col_map['ma'] = c
+        if "tên" in c: col_map['ten'] = c
+        if "niên" in c or "khoa" in c: col_map['khoa'] = c
 
-def detect_file_info(df):
-    content = df.head(15).to_string()
-    year_match = re.search(r'(\d{4})\s*-\s*(\d{4})', content)
-    nam_hoc = f"{year_match.group(1)}-{year_match.group(2)}" if year_match else None
-    
-    if "Học kỳ 1" in content or "HỌC KỲ 1" in content: hoc_ky = "HK1"
-    elif "Học kỳ 2" in content or "HỌC KỲ 2" in content: hoc_ky = "HK2"
-    else: hoc_ky = "CaNam"
-    return nam_hoc, hoc_ky
+    as_code = lambda col: [str(v).strip().replace('.0', '') for v in df[col].tolist()]
+    cccds = as_code(col_map.get('cccd', 'so_cccd'))
+    mas = as_code(col_map.get('ma', 'ma_hs'))
+    tens = df[col_map.get('ten', 'ho_ten')].tolist()
+    khoas = [str(v).strip() for v in df[col_map.get('khoa', 'nien_khoa')].tolist()]
+    return list(zip(cccds, mas, tens, khoas))
 
 def calculate_grade(student_nien_khoa, file_nam_hoc):
     try:
@@ -111,169 +944,543 @@ def calculate_grade(student_nien_khoa, file_nam_hoc):
         return 10 + delta if 0 <= delta <= 2 else 0
     except: return 0
 
-def process_upload_auto(df):
+def load_student_index():
+    """Index học sinh cho ingest: ma_hs -> (user id, nien_khoa).
+
+    Chỉ lấy các field cần thiết trong 1 lần đọc, dùng chung cho
+    cả lô file upload thay vì get() từng user.
+    """
+    return store.student_index()
+
+def load_existing_results(nam_hoc, hoc_ky):
+    """Điểm đã lưu của 1 kỳ (kèm đánh giá năm nếu CaNam): {(collection, doc_id): data}.
+
+    Đọc hàng loạt bằng 1-2 query thay vì get() từng document.
+    """
+    return store.load_existing_results(nam_hoc, hoc_ky)
+
+def build_score_writes(nam_hoc, hoc_ky, students, scores, assessments, student_index, existing=None, cards_complete=False):
+    """Chuyển kết quả parse thành các lệnh ghi, nhóm theo học sinh.
+
+    existing: kết quả load_existing_results -> chỉ ghi document mới hoặc có giá trị đổi.
+    cards_complete: report_cards đã backfill -> đánh dấu card ghi kèm là đầy đủ ('complete').
+    Trả về (groups, touched, students_updated, stats): groups là list các nhóm lệnh
+    (collection, doc_id, data, merge) của từng học sinh, touched là các user_id có dữ liệu mới,
+    stats = {'changed': số document ghi, 'unchanged': số document bỏ qua}.
+    """
+    # Chế độ ghi lại toàn bộ: coi như chưa có gì
+    existing = dict(existing) if existing is not None else None
+    stats = {'changed': 0, 'unchanged': 0}
+    def is_unchanged(key, data):
+        if existing is None: stats['changed'] += 1; return False
+        if existing.get(key) == data: stats['unchanged'] += 1; return True
+        existing[key] = data; stats['changed'] += 1
+        return False
+
+    score_groups = scores.groupby('block').indices
+    score_records = scores.to_dict('records')
+    ass_map = {a['block']: a for a in assessments.to_dict('records')}
+    groups, touched = [], set() # user có điểm mới -> xoá cache bảng điểm
+    students_updated = 0
+
+    for block, ma_hs in students['ma_hs'].items():
+        # Check user từ index
+        if ma_hs not in student_index: continue
+        user_id, nien_khoa = student_index[ma_hs]
+        
+        khoi = calculate_grade(nien_khoa, nam_hoc)
+        if khoi == 0: continue
+        
+        students_updated += 1
+        ops = []
+        card_scores = {}
+        for i in score_groups.get(block, []):
+            s = score_records[i]
+            mon = s['mon_hoc']
+            # FIREBASE LOGIC: Tạo ID duy nhất cho điểm để update
+            score_id = f"{user_id}_{nam_hoc}_{hoc_ky}_{mon}"
+            
+            score_data = {
+                'user_id': user_id, 'mon_hoc': mon, 'nam_hoc': nam_hoc,
+                'hoc_ky': hoc_ky, 'khoi': khoi,
+                'ddg_tx': s['tx'], 'ddg_gk': s['gk'], 'ddg_ck': s['ck'], 'dtb_mon': s['tb']
+            }
+            if is_unchanged(('scores', score_id), score_data): continue
+            ops.append(('scores', score_id, score_data, False)) # Upsert
+            card_scores[mon] = _card_score(score_data)
+        
+        # Đánh giá (Cả năm)
+        ass = ass_map.get(block)
+        if ass:
+            ass_id = f"{user_id}_{nam_hoc}"
+            ass_data = {
+                'user_id': user_id, 'nam_hoc': nam_hoc,
+                'kq_hoc_tap': ass['kq_hoc_tap'], 'kq_ren_luyen': ass['kq_ren_luyen'],
+                'danh_hieu': ass['danh_hieu'], 'nhan_xet': ass['nhan_xet']
+            }
+            if is_unchanged(('assessments', ass_id), ass_data): ass = None
+            else: ops.append(('assessments', ass_id, ass_data, False))
+
+        # Cập nhật bảng điểm tổng hợp trong cùng batch (merge: giữ các kỳ/năm khác)
+        card_year = {}
+        if card_scores: card_year['scores'] = {hoc_ky: card_scores}
+        if ass: card_year['assessment'] = _card_assessment(ass_data)
+        if card_year:
+            card = {'user_id': user_id, 'years': {nam_hoc: card_year}}
+            if cards_complete: card['complete'] = True
+            ops.append(('report_cards', user_id, card, True))
+
+        if ops:
+            groups.append(ops)
+            touched.add(user_id)
+    return groups, touched, students_updated, stats
+
+def chunk_write_groups(groups, chunk_size=400):
+    # Gom nhóm lệnh ghi thành các batch ~400 op (Firebase limit 500),
+    # không tách lệnh của 1 học sinh ra 2 batch
+    chunk = []
+    for ops in groups:
+        chunk.extend(ops)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+def commit_writes(ops):
+    return store.commit_writes(ops)
+
+PASS_SCORE = 5.0
+
+def build_cohort_values(nam_hoc, hoc_ky, students, scores, assessments, student_index):
+    """Gom dtb_mon / đánh giá của lô vừa parse theo (kind, khoi, mon_hoc) -> {user_id: giá trị}."""
+    who = students['ma_hs'].map(student_index.get).dropna()
+    if who.empty: return {}
+    users = pd.DataFrame(who.tolist(), index=who.index, columns=['user_id', 'nien_khoa'])
+    khoi_of = {nk: calculate_grade(nk, nam_hoc) for nk in users['nien_khoa'].unique()}
+    users['khoi'] = [khoi_of[nk] for nk in users['nien_khoa']]
+    users = users[users['khoi'] > 0]
+
+    cohort = {}
+    sc = scores.join(users, on='block', how='inner')
+    for (khoi, mon), g in sc.groupby(['khoi', 'mon_hoc'], sort=False):
+        cohort[('scores', int(khoi), mon)] = dict(zip(g['user_id'], g['tb']))
+    ass = assessments.join(users, on='block', how='inner')
+    for khoi, g in ass.groupby('khoi', sort=False):
+        cohort[('assessments', int(khoi), None)] = {
+            u: {'kq_hoc_tap': kq, 'danh_hieu': dh} for u, kq, dh in zip(g['user_id'], g['kq_hoc_tap'], g['danh_hieu'])}
+    return cohort
+
+def summarize_scores(values):
+    """Chỉ số của 1 môn từ {user_id: dtb_mon}. hist: 101 ô bước 0.1 (dùng cho phân bố và phân vị);
+    labels: số lượng điểm dạng chữ (Đ/CĐ...)."""
+    raw = pd.Series(list(values.values()), dtype=object).dropna().astype(str).str.strip()
+    raw = raw[raw != '']
+    num = pd.to_numeric(raw.str.replace(',', '.', regex=False), errors='coerce')
+    nums = num.dropna().to_numpy(dtype=float)
+    nums = nums[(nums >= 0) & (nums <= 10)]
+    labels = raw[num.isna()].value_counts().to_dict()
+    graded = len(nums) + labels.get('Đ', 0) + labels.get('CĐ', 0)
+    passed = int((nums >= PASS_SCORE).sum()) + labels.get('Đ', 0)
+    return {
+        'n': int(len(nums)),
+        'mean': float(nums.mean()) if len(nums) else None,
+        'median': float(np.median(nums)) if len(nums) else None,
+        'pass_rate': passed / graded if graded else None,
+        'hist': np.bincount(np.rint(nums * 10).astype(int), minlength=101).tolist(),
+        'labels': labels,
+    }
+
+def summarize_assessments(values):
+    df = pd.DataFrame(list(values.values()), columns=['kq_hoc_tap', 'danh_hieu'], dtype=object)
+    return {'n': len(df), 'counts': {c: df[c].dropna().value_counts().to_dict() for c in df.columns}}
+
+def percentile_in_cohort(hist, value):
+    """% học sinh cùng khối có điểm thấp hơn (tính nửa số bằng điểm), None nếu không phải điểm số."""
+    try: i = int(round(float(str(value).replace(',', '.')) * 10))
+    except (TypeError, ValueError): return None
+    total = sum(hist or [])
+    if not total or not 0 <= i < len(hist): return None
+    return 100 * (sum(hist[:i]) + hist[i] / 2) / total
+
+def update_cohort_stats(nam_hoc, hoc_ky, cohort):
+    """Gộp giá trị mới vào các document thống kê và tính lại chỉ số (không đổi -> không ghi)."""
+    for (kind, khoi, mon_hoc), values in cohort.items():
+        def merge(old, kind=kind, khoi=khoi, mon_hoc=mon_hoc, values=values):
+            old_values = (old or {}).get('values') or {}
+            merged = {**old_values, **values}
+            if old and merged == old_values: return None
+            summary = summarize_scores(merged) if kind == 'scores' else summarize_assessments(merged)
+            return {'kind': kind, 'nam_hoc': nam_hoc, 'hoc_ky': hoc_ky, 'khoi': khoi, 'mon_hoc': mon_hoc,
+                    **summary, 'values': merged}
+        store.update_cohort_doc(f"{nam_hoc}_{hoc_ky}_{khoi}_{mon_hoc or '#danh_gia'}", merge)
+    if cohort: invalidate_student_report([('cohort', nam_hoc, hoc_ky)]) # Cùng bảng version với cache bảng điểm
+
+def process_upload_auto(df, student_index=None, incremental=False):
     nam_hoc, hoc_ky = detect_file_info(df)
     if not nam_hoc: return "❌ Không tìm thấy 'Năm học' trong file.", "error"
 
-    row_count, col_count = df.shape
-    students_updated = 0
     progress = st.progress(0)
+    parsed = parse_score_sheet(df, hoc_ky, layout_key=layout_fingerprint(df, hoc_ky))
     
-    # Cache user để tránh query nhiều lần
-    all_users = db.collection('users').stream()
-    user_map = {doc.to_dict().get('ma_hs'): doc.id for doc in all_users}
-    
-    # Chuẩn bị batch write (ghi hàng loạt cho nhanh)
-    batch = db.batch()
-    batch_count = 0
-
-    for r in range(row_count):
-        if r % 50 == 0: progress.progress(min(r / row_count, 1.0))
-        for c in range(col_count):
-            val = str(df.iat[r, c]).strip()
-            if "Mã HS" in val:
-                ma_hs = ""
-                if ":" in val and len(val.split(':')[-1].strip()) > 3:
-                    ma_hs = val.split(':')[-1].strip()
-                else:
-                    for k in range(1, 6):
-                        if c + k < col_count:
-                            cand = str(df.iat[r, c + k]).strip()
-                            if len(cand) > 4 and cand[0].isdigit():
-                                ma_hs = cand; break
-                
-                if not ma_hs: continue
-                ma_hs = ma_hs.replace('.0', '')
-                
-                # Check user từ map
-                user_id = user_map.get(ma_hs)
-                if not user_id: continue
-
-                # Lấy info user để tính khối (phải query lẻ nếu ko cache hết info)
-                # Để tối ưu, ở đây ta query lẻ nếu cần thiết, hoặc giả định user map có nien_khoa
-                # Đơn giản hóa: Query lẻ user để lấy nien_khoa chính xác
-                user_doc = db.collection('users').document(user_id).get()
-                user_data = user_doc.to_dict()
-                
-                khoi = calculate_grade(user_data.get('nien_khoa'), nam_hoc)
-                if khoi == 0: continue
-                
-                students_updated += 1
-                
-                # Tìm header
-                header_row = -1; col_mon = -1
-                for k in range(1, 9):
-                    if r + k >= row_count: break
-                    for check_c in range(col_count):
-                        txt = str(df.iat[r+k, check_c]).lower()
-                        if "môn" in txt and "học" in txt:
-                            header_row = r + k; col_mon = check_c; break
-                    if header_row != -1: break
-                if header_row == -1: continue
-
-                # Map cột
-                col_tx = col_gk = col_ck = col_tb = -1
-                for cc in range(col_count):
-                    h_txt = str(df.iat[header_row, cc]).lower()
-                    if hoc_ky == "CaNam":
-                        if "cả năm" in h_txt: col_tb = cc
-                        elif col_tb == -1 and ("tb" == h_txt or "tbm" in h_txt): col_tb = cc
-                    else:
-                        if "tx" in h_txt: col_tx = cc
-                        elif "gk" in h_txt: col_gk = cc
-                        elif "ck" in h_txt: col_ck = cc
-                        elif h_txt == "tb" or "tbm" in h_txt: col_tb = cc
-                
-                # Đọc điểm
-                curr = header_row + 1; last_row = curr
-                for _ in range(25):
-                    if curr >= row_count: break
-                    mon = str(df.iat[curr, col_mon]).strip()
-                    if not mon or mon.lower() in ['nan', ''] or "kết quả" in mon.lower() or "xếp loại" in mon.lower():
-                        last_row = curr; break
-                    if mon.isdigit(): continue
-
-                    v_tx = clean_str(df.iat[curr, col_tx]) if col_tx != -1 else None
-                    v_gk = clean_str(df.iat[curr, col_gk]) if col_gk != -1 else None
-                    v_ck = clean_str(df.iat[curr, col_ck]) if col_ck != -1 else None
-                    v_tb = clean_str(df.iat[curr, col_tb]) if col_tb != -1 else None
-                    
-                    if hoc_ky == "CaNam" and not v_tb: curr += 1; continue
-
-                    # FIREBASE LOGIC: Tạo ID duy nhất cho điểm để update
-                    score_id = f"{user_id}_{nam_hoc}_{hoc_ky}_{mon}"
-                    score_ref = db.collection('scores').document(score_id)
-                    
-                    score_data = {
-                        'user_id': user_id, 'mon_hoc': mon, 'nam_hoc': nam_hoc,
-                        'hoc_ky': hoc_ky, 'khoi': khoi,
-                        'ddg_tx': v_tx, 'ddg_gk': v_gk, 'ddg_ck': v_ck, 'dtb_mon': v_tb
-                    }
-                    batch.set(score_ref, score_data) # Upsert
-                    batch_count += 1
-                    curr += 1; last_row = curr
-                
-                # Đánh giá (Cả năm)
-                if hoc_ky == "CaNam":
-                    k_ht = k_rl = dh = nx = None
-                    for k in range(15):
-                        chk_r = last_row + k
-                        if chk_r >= row_count: break
-                        row_txt = " | ".join([str(df.iat[chk_r, cx]) for cx in range(col_count) if pd.notna(df.iat[chk_r, cx])])
-                        if "KQHT" in row_txt or "Học lực" in row_txt:
-                            parts = row_txt.split('|')
-                            for p in parts:
-                                if "KQHT" in p or "Học lực" in p: k_ht = p.split(':')[-1].strip()
-                                if "KQRL" in p or "Hạnh kiểm" in p: k_rl = p.split(':')[-1].strip()
-                                if "Danh hiệu" in p: dh = p.split(':')[-1].strip()
-                        if "Nhận xét" in row_txt: nx = row_txt.split(':')[-1].strip()
-                    
-                    if k_ht or k_rl or dh:
-                        ass_id = f"{user_id}_{nam_hoc}"
-                        ass_ref = db.collection('assessments').document(ass_id)
-                        ass_data = {
-                            'user_id': user_id, 'nam_hoc': nam_hoc,
-                            'kq_hoc_tap': k_ht, 'kq_ren_luyen': k_rl,
-                            'danh_hieu': dh, 'nhan_xet': nx
-                        }
-                        batch.set(ass_ref, ass_data)
-                        batch_count += 1
-
-                # Commit batch mỗi 400 operations (Firebase limit 500)
-                if batch_count >= 400:
-                    batch.commit()
-                    batch = db.batch()
-                    batch_count = 0
-
-    batch.commit() # Commit phần còn lại
+    # Index user (ma_hs -> id, nien_khoa), truyền từ ngoài để dùng chung cho nhiều file
+    if student_index is None: student_index = load_student_index()
+    existing = load_existing_results(nam_hoc, hoc_ky) if incremental else None
+    groups, touched, students_updated, stats = build_score_writes(nam_hoc, hoc_ky, *parsed, student_index, existing, report_cards_backfilled())
+    cohort = build_cohort_values(nam_hoc, hoc_ky, *parsed, student_index)
+
+    total = max(sum(len(ops) for ops in groups), 1); done = 0
+    for chunk in chunk_write_groups(groups):
+        done += commit_writes(chunk)
+        progress.progress(min(done / total, 1.0))
+    invalidate_student_report(touched)
+    update_cohort_stats(nam_hoc, hoc_ky, cohort)
     progress.empty()
-    return f"Xử lý xong {students_updated} HS. ({nam_hoc} - {hoc_ky})", "success"
+    msg = f"Xử lý xong {students_updated} HS. ({nam_hoc} - {hoc_ky})"
+    if incremental: msg += f" · thay đổi {stats['changed']} / không đổi {stats['unchanged']}"
+    return msg, "success"
 
 # ==========================================
-# 4. UI HỌC SINH (GIỮ NGUYÊN GIAO DIỆN)
+# 4. UPLOAD ĐIỂM CHẠY NỀN (NHIỀU FILE SONG SONG)
 # ==========================================
+# Parse (CPU) chạy trong process pool, commit batch (I/O) chạy trong thread pool giới hạn.
+# Job chạy trong thread nền và lưu trạng thái ở cache_resource -> admin rời trang rồi quay lại vẫn xem được.
+
+# Dấu vân tay file (sha256): file chính là lần upload mới nhất của mọi kỳ trong file
+# (và danh sách học sinh không đổi) -> bỏ qua. Upload lại file cũ hơn vẫn được ghi (so từng dòng).
+def file_fingerprint(data):
+    return hashlib.sha256(data).hexdigest()
+
+def student_index_hash(student_index):
+    # Hash nội dung index (ma_hs -> id, niên khóa): sửa mã / niên khóa mà không đổi số HS vẫn nhận ra
+    return hashlib.sha256(json.dumps(sorted(student_index.items()), ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def _is_last_upload(fingerprint, index_hash, terms):
+    for nam_hoc, hoc_ky in terms:
+        last = store.last_upload(nam_hoc, hoc_ky)
+        if not last or last.get('fingerprint') != fingerprint or last.get('index_hash') != index_hash: return False
+    return True
+
+def _record_upload(terms, fingerprint, name, index_hash, students_updated):
+    for nam_hoc, hoc_ky in terms: store.record_upload(nam_hoc, hoc_ky, fingerprint, name, index_hash, students_updated)
 
-def render_html_grade_table(scores, loai_ky):
+# Streamlit chạy script như module __main__ giả (__spec__ None, __file__ = script) -> process con spawn sẽ
+# import lại cả app (kết nối database...). Spec tên "__main__" báo multiprocessing bỏ qua bước đó:
+# worker parse nằm trong parsing.py, không cần gì từ script này.
+if __name__ == "__main__" and __spec__ is None: __spec__ = importlib.machinery.ModuleSpec("__main__", None)
+
+def iter_parsed_files(files):
+    """Parse song song [(tên file, bytes), ...], yield (tên file, kết quả parse_score_file hoặc Exception) theo thứ tự xong.
+
+    Process pool spawn (không fork process đang chạy thread / kết nối gRPC); pool không chạy được
+    (không tạo được process, process con chết...) -> parse nốt các file còn lại bằng thread pool.
+    """
+    left = dict(files)
+    workers = max(1, min(len(left), os.cpu_count() or 1))
+    pools = [lambda: ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn')), lambda: ThreadPoolExecutor(workers)]
+    for make_pool in pools:
+        if not left: return
+        try:
+            with make_pool() as pool:
+                futures = {pool.submit(parse_score_file, name, data): name for name, data in left.items()}
+                for fut in as_completed(futures):
+                    try: result = fut.result()
+                    except BrokenExecutor: continue # Pool hỏng: file này parse lại ở pool sau
+                    except Exception as e: result = e
+                    name = futures[fut]; del left[name]
+                    yield name, result
+        except Exception:
+            logging.getLogger(__name__).warning("Pool parse lỗi, parse lại các file còn lại", exc_info=True)
+
+@st.cache_resource
+def _upload_jobs():
+    return {'lock': threading.Lock(), 'jobs': {}}
+
+def start_upload_job(files, incremental=True, commit_workers=4):
+    """Chạy upload điểm nền cho [(tên file, bytes), ...]. Trả về job id.
+
+    incremental: bỏ qua file trùng vân tay và chỉ ghi điểm mới/thay đổi.
+    """
+    registry = _upload_jobs()
+    job = {
+        'id': uuid.uuid4().hex[:8], 'started_at': time.time(), 'finished_at': None,
+        'files': {name: {'status': 'Đang chờ', 'progress': 0.0, 'message': None, 'ok': None} for name, _ in files}
+    }
+    with registry['lock']:
+        registry['jobs'][job['id']] = job
+        # Chỉ giữ 10 job gần nhất
+        for old in sorted(registry['jobs'], key=lambda j: registry['jobs'][j]['started_at'])[:-10]:
+            registry['jobs'].pop(old)
+    def run():
+        with perf_scope(f"upload:{job['id']}"): _run_upload_job(job, files, incremental, commit_workers)
+    threading.Thread(target=run, daemon=True).start()
+    return job['id']
+
+def _run_upload_job(job, files, incremental, commit_workers):
+    lock = _upload_jobs()['lock']
+    finished = {name: threading.Event() for name, _ in files}
+    def finish(name, ok, message):
+        with lock: job['files'][name].update(status='Xong' if ok else 'Lỗi', progress=1.0, ok=ok, message=message)
+        finished[name].set()
+
+    try:
+        student_index = load_student_index() # 1 lần cho cả lô file
+    except Exception as e:
+        for name, _ in files: finish(name, False, f"Lỗi tải danh sách học sinh: {e}")
+        job['finished_at'] = time.time()
+        return
+
+    index_hash = student_index_hash(student_index)
+    cards_complete = report_cards_backfilled()
+    fingerprints = {name: file_fingerprint(data) for name, data in files}
+
+    existing_cache = {}
+    def existing_for(nam_hoc, hoc_ky):
+        # Điểm đã có của mỗi kỳ chỉ tải 1 lần cho cả job
+        if not incremental: return None
+        if (nam_hoc, hoc_ky) not in existing_cache:
+            existing_cache[(nam_hoc, hoc_ky)] = load_existing_results(nam_hoc, hoc_ky)
+        return existing_cache[(nam_hoc, hoc_ky)]
+
+    def in_upload_order(results):
+        # Parse xong theo thứ tự bất kỳ, nhưng xử lý / ghi theo thứ tự upload: file sau thắng như upload tuần tự
+        order, ready = [name for name, _ in files], {}
+        for name, parsed in results:
+            ready[name] = parsed
+            while order and order[0] in ready:
+                first = order.pop(0)
+                yield first, ready.pop(first)
+
+    term_last = {} # (nam_hoc, hoc_ky) -> file gần nhất trong job có kỳ này
+    commits = []
+    with ThreadPoolExecutor(commit_workers, initializer=_perf_scope.set, initargs=(_perf_scope.get(),)) as commit_pool:
+        for name in job['files']: job['files'][name]['status'] = 'Đang đọc file'
+        for name, parsed in in_upload_order(iter_parsed_files(files)):
+            try:
+                if isinstance(parsed, Exception): raise parsed
+                if parsed.get('error'): finish(name, False, parsed['error']); continue
+                terms = list(dict.fromkeys((sh['nam_hoc'], sh['hoc_ky']) for sh in parsed['sheets']))
+                # File trước cùng kỳ phải ghi xong rồi mới so / ghi file này (cùng học sinh -> kết quả không phụ thuộc thời gian)
+                for prev in dict.fromkeys(term_last[t] for t in terms if t in term_last):
+                    finished[prev].wait()
+                    if not job['files'][prev]['ok']: # Ghi lỗi: điểm trong cache không còn đúng -> tải lại
+                        for t in terms: existing_cache.pop(t, None)
+                if incremental:
+                    try: repeat = _is_last_upload(fingerprints[name], index_hash, terms)
+                    except Exception: repeat = False # Không kiểm tra được -> xử lý như file mới
+                    if repeat:
+                        finish(name, True, "⏭️ File giống hệt lần upload trước, không có gì thay đổi."); continue
+                groups, touched, n, labels, cohorts = [], set(), 0, [], []
+                stats = {'changed': 0, 'unchanged': 0}
+                for sh in parsed['sheets']:
+                    g, t, k, st_ = build_score_writes(
+                        sh['nam_hoc'], sh['hoc_ky'], sh['students'], sh['scores'], sh['assessments'],
+                        student_index, existing_for(sh['nam_hoc'], sh['hoc_ky']), cards_complete)
+                    groups += g; touched |= t; n += k
+                    if incremental: # File sau trong job so với dữ liệu sau khi ghi file này
+                        existing_for(sh['nam_hoc'], sh['hoc_ky']).update(
+                            ((c, doc_id), data) for ops in g for c, doc_id, data, _ in ops if c in ('scores', 'assessments'))
+                    cohorts.append((sh['nam_hoc'], sh['hoc_ky'],
+                                    build_cohort_values(sh['nam_hoc'], sh['hoc_ky'], sh['students'], sh['scores'], sh['assessments'], student_index)))
+                    for key in stats: stats[key] += st_[key]
+                    label = f"{sh['nam_hoc']} - {sh['hoc_ky']}"
+                    if label not in labels: labels.append(label)
+            except Exception as e:
+                finish(name, False, str(e)); continue
+            for t in terms: term_last[t] = name
+
+            chunks = list(chunk_write_groups(groups))
+            state = {'left': len(chunks), 'done_ops': 0, 'total_ops': max(sum(len(c) for c in chunks), 1), 'error': None}
+            sheet_note = f", {len(parsed['sheets'])} sheet" if len(parsed['sheets']) > 1 else ""
+            message = f"Xử lý xong {n} HS. ({'; '.join(labels)}{sheet_note})"
+            if incremental: message += f" · thay đổi {stats['changed']} / không đổi {stats['unchanged']}"
+            with lock: job['files'][name]['status'] = 'Đang ghi điểm'
+
+            def done(name=name, n=n, message=message, cohorts=cohorts, terms=terms):
+                try:
+                    for nam_hoc, hoc_ky, cohort in cohorts: update_cohort_stats(nam_hoc, hoc_ky, cohort)
+                except Exception as e:
+                    # Không lưu vân tay -> upload lại file này sẽ cập nhật thống kê
+                    finish(name, True, f"{message} · ⚠️ Chưa cập nhật thống kê: {e}"); return
+                try: _record_upload(terms, fingerprints[name], name, index_hash, n)
+                except Exception: pass # Chỉ ảnh hưởng lần upload lại sau
+                finish(name, True, message)
+
+            if not chunks:
+                done(); continue
+
+            def on_commit(fut, name=name, state=state, touched=touched, done=done):
+                with lock:
+                    state['left'] -= 1
+                    if fut.exception(): state['error'] = str(fut.exception())
+                    else: state['done_ops'] += fut.result()
+                    job['files'][name]['progress'] = state['done_ops'] / state['total_ops']
+                    last = state['left'] == 0
+                if last:
+                    invalidate_student_report(touched)
+                    if state['error']: finish(name, False, f"Lỗi ghi dữ liệu: {state['error']}")
+                    else: done()
+
+            for chunk in chunks:
+                f = commit_pool.submit(commit_writes, chunk)
+                f.add_done_callback(on_commit)
+                commits.append(f)
+        wait(commits)
+    job['finished_at'] = time.time()
+
+def list_upload_jobs():
+    registry = _upload_jobs()
+    with registry['lock']:
+        jobs = [dict(j, files={k: dict(v) for k, v in j['files'].items()}) for j in registry['jobs'].values()]
+    return sorted(jobs, key=lambda j: j['started_at'], reverse=True)
+
+@st.fragment(run_every=2)
+def render_upload_jobs():
+    # Tự làm mới mỗi 2 giây, chỉ đọc trạng thái trong bộ nhớ (không query Firestore)
+    for job in list_upload_jobs()[:3]:
+        running = job['finished_at'] is None
+        started = time.strftime('%H:%M:%S', time.localtime(job['started_at']))
+        st.caption(f"Job {job['id']} · bắt đầu {started} · {'⏳ đang chạy' if running else '✔️ hoàn tất'}")
+        for name, f in job['files'].items():
+            if f['ok'] is None: st.progress(f['progress'], text=f"{name}: {f['status']}")
+            elif f['ok']: st.success(f"✅ {name}: {f['message']}")
+            else: st.error(f"❌ {name}: {f['message']}")
+
+# ==========================================
+# 5. XUẤT DỮ LIỆU (ADMIN)
+# ==========================================
+# Bảng ngang: 1 dòng / học sinh, 1 cột / môn (dtb_mon) + đánh giá cuối năm.
+# scores được đọc theo trang, thứ tự document ID (= theo user_id) -> điểm của 1 học sinh
+# nằm liền nhau, gom xong là đẩy ra ngay. RAM chỉ giữ index user + đánh giá (1 dòng / HS).
+EXPORT_FORMATS = {'xlsx': 'Excel (.xlsx)', 'csv': 'CSV (.csv)', 'parquet': 'Parquet (.parquet)'}
+EXPORT_INFO_COLUMNS = ['Mã HS', 'Họ tên', 'Niên khóa', 'Khối']
+EXPORT_ASSESSMENT_COLUMNS = {'kq_hoc_tap': 'Học lực', 'kq_ren_luyen': 'Hạnh kiểm', 'danh_hieu': 'Danh hiệu', 'nhan_xet': 'Nhận xét'}
+# Cột không phải môn: ghi nguyên giá trị (Mã HS giữ số 0 đầu, tên "NaN"/"Inf" không thành số)
+EXPORT_FIXED_COLUMNS = set(EXPORT_INFO_COLUMNS) | set(EXPORT_ASSESSMENT_COLUMNS.values())
+
+def iter_export_rows(nam_hoc, hoc_ky, nien_khoa=None, page_size=1000):
+    """Sinh từng dòng (dict) của bảng xuất; join với user qua index trong RAM, không get() từng dòng."""
+    directory = store.user_directory(nien_khoa)
+    assessments = {}
+    if hoc_ky == "CaNam": # Đánh giá (Học lực / Hạnh kiểm...) là của cả năm: bảng HK1 / HK2 không có
+        for page in store.iter_results('assessments', nam_hoc, fields=['user_id', *EXPORT_ASSESSMENT_COLUMNS], page_size=page_size):
+            for a in page:
+                if a.get('user_id') in directory:
+                    assessments.setdefault(a['user_id'], {label: a.get(k) for k, label in EXPORT_ASSESSMENT_COLUMNS.items()})
+
+    def student_row(user_id, khoi):
+        u = directory[user_id]
+        return {'Mã HS': u.get('ma_hs'), 'Họ tên': u.get('ho_ten'), 'Niên khóa': u.get('nien_khoa'), 'Khối': khoi,
+                **assessments.pop(user_id, {})}
+
+    current, row = None, None
+    for page in store.iter_results('scores', nam_hoc, hoc_ky, fields=['user_id', 'mon_hoc', 'khoi', 'dtb_mon'], page_size=page_size):
+        for s in page:
+            user_id = s.get('user_id')
+            if user_id not in directory: continue
+            if user_id != current:
+                if row: yield row
+                current, row = user_id, student_row(user_id, s.get('khoi'))
+            row[s.get('mon_hoc')] = s.get('dtb_mon')
+    if row: yield row
+    # Có đánh giá nhưng không có điểm trong học kỳ đã chọn
+    for user_id in list(assessments):
+        yield student_row(user_id, None)
+
+def _export_cell(v):
+    # Cột môn: điểm dạng số -> số trong Excel, giữ nguyên "Đ"/"CĐ"... (và "nan"/"inf" không phải điểm)
+    if isinstance(v, str):
+        try: x = float(v)
+        except ValueError: return v
+        return x if np.isfinite(x) else v
+    return v
+
+def _write_export(fmt, out, columns, chunks, title):
+    if fmt == 'csv':
+        text = io.TextIOWrapper(out, encoding='utf-8-sig', newline='') # BOM để Excel đọc đúng tiếng Việt
+        pd.DataFrame(columns=columns).to_csv(text, index=False)
+        for chunk in chunks:
+            pd.DataFrame(chunk, columns=columns).to_csv(text, index=False, header=False)
+        text.flush(); text.detach()
+    elif fmt == 'xlsx':
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet(title)
+        ws.append(columns)
+        numeric = [c not in EXPORT_FIXED_COLUMNS for c in columns]
+        for chunk in chunks:
+            for row in chunk: ws.append([_export_cell(row.get(c)) if num else row.get(c) for c, num in zip(columns, numeric)])
+        wb.save(out)
+    elif fmt == 'parquet':
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError: raise RuntimeError("Cần cài pyarrow để xuất Parquet.")
+        schema = pa.schema([(c, pa.int64() if c == 'Khối' else pa.string()) for c in columns])
+        with pq.ParquetWriter(out, schema) as writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pylist([{c: row.get(c) for c in columns} for row in chunk], schema=schema))
+    else: raise ValueError(f"Định dạng không hỗ trợ: {fmt}")
+
+def export_results(nam_hoc, hoc_ky, nien_khoa=None, fmt='xlsx', chunk_rows=500, page_size=1000):
+    """Xuất bảng điểm ngang của 1 năm học / học kỳ (lọc niên khóa nếu có). Trả về (bytes, số học sinh).
+
+    Dòng được gom thành chunk và ghi tạm ra đĩa; danh sách môn chỉ đủ sau khi duyệt
+    hết nên file đích được ghi ở lượt 2, từng chunk một -> RAM không phụ thuộc số học sinh.
+    """
+    subjects, has_assessment, n = set(), False, 0
+    with tempfile.TemporaryFile() as spool:
+        chunk = []
+        for row in iter_export_rows(nam_hoc, hoc_ky, nien_khoa, page_size):
+            subjects.update(k for k in row if k not in EXPORT_FIXED_COLUMNS)
+            has_assessment = has_assessment or 'Học lực' in row
+            chunk.append(row); n += 1
+            if len(chunk) >= chunk_rows:
+                pickle.dump(chunk, spool); chunk = []
+        if chunk: pickle.dump(chunk, spool)
+        spool.seek(0)
+
+        def chunks():
+            while True:
+                try: yield pickle.load(spool)
+                except EOFError: return
+
+        columns = EXPORT_INFO_COLUMNS + sorted(subjects) + (list(EXPORT_ASSESSMENT_COLUMNS.values()) if has_assessment else [])
+        out = io.BytesIO()
+        _write_export(fmt, out, columns, chunks(), f"{hoc_ky} {nam_hoc}")
+    return out.getvalue(), n
+
+# ==========================================
+# 6. UI HỌC SINH (GIỮ NGUYÊN GIAO DIỆN)
+# ==========================================
+
+def cohort_percentiles(scores, nam_hoc, hoc_ky, khoi):
+    # Phân vị trong khối từ thống kê tính sẵn (cache dùng chung -> không tốn thêm lượt đọc mỗi lần xem)
+    hists = {d['mon_hoc']: d.get('hist') for d in get_cohort_stats(nam_hoc, hoc_ky)
+             if d.get('kind') == 'scores' and d.get('khoi') == khoi}
+    return {s.get('mon_hoc'): percentile_in_cohort(hists.get(s.get('mon_hoc')), s.get('dtb_mon')) for s in scores}
+
+def render_html_grade_table(scores, loai_ky, percentiles=None):
     if loai_ky == "CaNam": headers = ["Môn học", "TB Cả Năm"]
     else: headers = ["Môn học", "ĐĐGtx (TX)", "ĐĐGgk (GK)", "ĐĐGck (CK)", "TB Môn"]
 
     rows_html = ""
     for s in scores:
         mon_div = f"<div class='mon-hoc'>{s.get('mon_hoc')}</div>"
+        pct = (percentiles or {}).get(s.get('mon_hoc'))
+        pct_div = f"<div class='pct'>hơn {pct:.0f}% khối</div>" if pct is not None else ""
         if loai_ky == "CaNam":
-            rows_html += f"<tr><td>{mon_div}</td><td>{s.get('dtb_mon') or '-'}</td></tr>"
+            rows_html += f"<tr><td>{mon_div}</td><td>{s.get('dtb_mon') or '-'}{pct_div}</td></tr>"
         else:
-            rows_html += f"<tr><td>{mon_div}</td><td class='tx-col'>{s.get('ddg_tx') or ''}</td><td>{s.get('ddg_gk') or ''}</td><td>{s.get('ddg_ck') or ''}</td><td>{s.get('dtb_mon') or ''}</td></tr>"
+            rows_html += f"<tr><td>{mon_div}</td><td class='tx-col'>{s.get('ddg_tx') or ''}</td><td>{s.get('ddg_gk') or ''}</td><td>{s.get('ddg_ck') or ''}</td><td>{s.get('dtb_mon') or ''}{pct_div}</td></tr>"
             
     thead = "".join([f"<th>{h}</th>" for h in headers])
-    css = """<style>.g-cont {overflow-x:auto; margin-bottom:15px; border:1px solid #c8e6c9; border-radius:8px; background:white;} table {width:100%; border-collapse:collapse; font-family:sans-serif; font-size:14px; min-width:100%;} th, td {padding:8px; border:1px solid #c8e6c9; text-align:center; vertical-align:middle; color:#2e7d32;} th {background:#e8f5e9; color:#1b5e20; font-weight:bold;} th:first-child, td:first-child {position:sticky; left:0; background:#fff; z-index:5; text-align:left; border-right:2px solid #a5d6a7; color:#1b5e20; font-weight:bold; width:90px; min-width:90px; max-width:90px;} th:first-child {background:#e8f5e9; z-index:6;} .mon-hoc {white-space:normal; word-wrap:break-word; line-height:1.3;} .tx-col {white-space:normal; min-width:90px;} td:last-child {background:#f1f8e9; font-weight:bold; color:#1b5e20;}</style>"""
+    css = """<style>.g-cont {overflow-x:auto; margin-bottom:15px; border:1px solid #c8e6c9; border-radius:8px; background:white;} table {width:100%; border-collapse:collapse; font-family:sans-serif; font-size:14px; min-width:100%;} th, td {padding:8px; border:1px solid #c8e6c9; text-align:center; vertical-align:middle; color:#2e7d32;} th {background:#e8f5e9; color:#1b5e20; font-weight:bold;} th:first-child, td:first-child {position:sticky; left:0; background:#fff; z-index:5; text-align:left; border-right:2px solid #a5d6a7; color:#1b5e20; font-weight:bold; width:90px; min-width:90px; max-width:90px;} th:first-child {background:#e8f5e9; z-index:6;} .mon-hoc {white-space:normal; word-wrap:break-word; line-height:1.3;} .tx-col {white-space:normal; min-width:90px;} td:last-child {background:#f1f8e9; font-weight:bold; color:#1b5e20;} .pct {font-size:11px; font-weight:normal; color:#558b2f;}</style>"""
     return f"{css}<div class='g-cont'><table><thead><tr>{thead}</tr></thead><tbody>{rows_html}</tbody></table></div>"
 
 def student_ui(user_data):
     st.markdown(f"### 👋 Xin chào, <span style='color:#1b5e20'>{user_data['ho_ten']}</span>", unsafe_allow_html=True)
     
     # Check pass
-    if check_password_hash(user_data['password_hash'], "123456"):
+    if user_data.get('must_change_password'):
         st.warning("⚠️ CẢNH BÁO: Mật khẩu mặc định.")
         st.info("🔒 Vui lòng đổi mật khẩu mới để xem điểm.")
         with st.form("change_pass_form"):
@@ -282,10 +1489,10 @@ def student_ui(user_data):
             if st.form_submit_button("Lưu & Xem điểm", type="primary"):
                 if new_p != conf_p: st.error("Mật khẩu không khớp.")
                 elif len(new_p) < 6: st.error("Quá ngắn.")
-                elif new_p == "123456": st.error("Không dùng lại pass cũ.")
+                elif new_p == DEFAULT_PASSWORD: st.error("Không dùng lại pass cũ.")
                 else:
                     new_hash = generate_password_hash(new_p)
-                    db.collection('users').document(user_data['id']).update({'password_hash': new_hash})
+                    store.update_user(user_data['doc_id'], {'password_hash': new_hash, 'must_change_password': False})
                     st.success("Thành công! Đăng nhập lại."); st.session_state.logged_in = False; st.rerun()
         return
 
@@ -306,6 +1513,8 @@ def student_ui(user_data):
         years_map = {10: f"{start_year}-{start_year+1}", 11: f"{start_year+1}-{start_year+2}", 12: f"{start_year+2}-{start_year+3}"}
     except: st.error("Lỗi Niên khóa."); return
 
+    report = get_student_report(user_data['id'])
+    compare = st.toggle("📊 So sánh với khối")
     t10, t11, t12 = st.tabs(["Lớp 10", "Lớp 11", "Lớp 12"])
     
     for grade, tab in zip([10, 11, 12], [t10, t11, t12]):
@@ -313,10 +1522,10 @@ def student_ui(user_data):
             target_nam = years_map[grade]
             st.caption(f"Năm học: {target_nam}")
             
-            hk1 = get_scores(user_data['id'], target_nam, "HK1")
-            hk2 = get_scores(user_data['id'], target_nam, "HK2")
-            cn = get_scores(user_data['id'], target_nam, "CaNam")
-            ass = get_assessment(user_data['id'], target_nam)
+            hk1 = report['scores'].get((target_nam, "HK1"), [])
+            hk2 = report['scores'].get((target_nam, "HK2"), [])
+            cn = report['scores'].get((target_nam, "CaNam"), [])
+            ass = report['assessments'].get(target_nam)
 
             if not (hk1 or hk2 or cn):
                 st.info("📭 Chưa có dữ liệu.")
@@ -324,25 +1533,30 @@ def student_ui(user_data):
             
             if hk1:
                 st.markdown("**🍂 Học kỳ 1**")
-                st.markdown(render_html_grade_table(hk1, "HK1"), unsafe_allow_html=True)
+                pct = cohort_percentiles(hk1, target_nam, "HK1", grade) if compare else None
+                st.markdown(render_html_grade_table(hk1, "HK1", pct), unsafe_allow_html=True)
             if hk2:
                 st.markdown("**🌸 Học kỳ 2**")
-                st.markdown(render_html_grade_table(hk2, "HK2"), unsafe_allow_html=True)
+                pct = cohort_percentiles(hk2, target_nam, "HK2", grade) if compare else None
+                st.markdown(render_html_grade_table(hk2, "HK2", pct), unsafe_allow_html=True)
             if cn:
                 st.markdown("**🏆 Cả năm**")
-                st.markdown(render_html_grade_table(cn, "CaNam"), unsafe_allow_html=True)
+                pct = cohort_percentiles(cn, target_nam, "CaNam", grade) if compare else None
+                st.markdown(render_html_grade_table(cn, "CaNam", pct), unsafe_allow_html=True)
             
             if ass:
                 st.markdown(f"""<div style="background:#e8f5e9; padding:15px; border-radius:8px; border-left:5px solid #2e7d32; margin-top:10px; color:#1b5e20"><h4 style="margin:0">📝 Đánh giá cuối năm</h4><p style="margin:5px 0"><b>Học lực:</b> {ass.get('kq_hoc_tap') or '--'} &nbsp;|&nbsp; <b>Hạnh kiểm:</b> {ass.get('kq_ren_luyen') or '--'}</p><p style="margin:5px 0"><b>Danh hiệu:</b> <span style="color:#d32f2f; font-weight:bold">{ass.get('danh_hieu') or '--'}</span></p><p style="margin:5px 0; font-style:italic">"{ass.get('nhan_xet') or ''}"</p></div>""", unsafe_allow_html=True)
 
 # ==========================================
-# 5. ADMIN UI
+# 7. ADMIN UI
 # ==========================================
 def admin_ui():
-    st.title("⚙️ Quản Trị (Firebase)")
+    st.title(f"⚙️ Quản Trị ({'Firebase' if store.name == 'firestore' else 'SQL'})")
     if st.button("Đăng xuất"): st.session_state.logged_in = False; st.rerun()
+    with st.expander("🩺 Trạng thái hệ thống"):
+        st.json(health_status())
 
-    tab1, tab2 = st.tabs(["📤 Upload Dữ Liệu", "👥 Quản Lý User"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["📤 Upload Dữ Liệu", "👥 Quản Lý User", "📥 Xuất Dữ Liệu", "📊 Thống Kê", "⏱️ Hiệu Năng"])
 
     with tab1:
         st.subheader("1. Import User (Excel)")
@@ -351,56 +1565,67 @@ def admin_ui():
         if f_acc and st.button("Import"):
             try:
                 df = pd.read_excel(f_acc)
-                df.columns = [str(c).strip().lower() for c in df.columns]
-                col_map = {}
-                for c in df.columns:
-                    if "cccd" in c: col_map['cccd'] = c
-                    if "mã" in c or "ma_hs" in c: col_map['ma'] = c
-                    if "tên" in c: col_map['ten'] = c
-                    if "niên" in c or "khoa" in c: col_map['khoa'] = c
-                
-                cnt = 0
-                for _, row in df.iterrows():
-                    cccd = str(row[col_map.get('cccd', 'so_cccd')]).strip().replace('.0','')
-                    ma = str(row[col_map.get('ma', 'ma_hs')]).strip().replace('.0','')
-                    ten = row[col_map.get('ten', 'ho_ten')]
-                    khoa = str(row[col_map.get('khoa', 'nien_khoa')]).strip()
-                    
-                    if create_or_update_user(cccd, ma, ten, khoa):
-                        cnt += 1
-                st.success(f"Đã tạo mới {cnt} user.")
+                res = bulk_import_users(parse_user_sheet(df))
+                st.success(f"Tạo mới {res['created']} · Cập nhật {res['updated']} · Không đổi {res['unchanged']} user.")
             except Exception as e: st.error(f"Lỗi: {e}")
 
         st.divider(); st.subheader("2. Upload Điểm")
         files = st.file_uploader("Chọn file điểm", accept_multiple_files=True, key="scr")
+        incremental = st.checkbox("Chỉ ghi điểm mới / thay đổi (bỏ qua file đã xử lý)", value=True)
         if files and st.button("Xử lý Điểm"):
-            for f in files:
-                try:
-                    eng = 'xlrd' if f.name.endswith('.xls') else 'openpyxl'
-                    df = pd.read_excel(f, header=None, engine=eng)
-                    msg, stt = process_upload_auto(df)
-                    if stt == "success": st.success(f"✅ {f.name}: {msg}")
-                    else: st.error(f"❌ {f.name}: {msg}")
-                except Exception as e: st.error(f"Lỗi {f.name}: {e}")
+            start_upload_job([(f.name, f.getvalue()) for f in files], incremental=incremental)
+            st.info("Đã bắt đầu xử lý nền, có thể rời trang và quay lại xem kết quả.")
+        render_upload_jobs()
+
+        if store.name == "firestore": # Chỉ cần cho dữ liệu trên Firestore
+            st.divider(); st.subheader("3. Bảo Trì Dữ Liệu")
+            st.caption("Dựng lại report_cards từ scores/assessments (backfill dữ liệu cũ). Chạy 1 lần sau khi triển khai: từ đó học sinh xem bảng điểm chỉ tốn 1 lần đọc.")
+            if st.button("Dựng lại"):
+                with st.spinner("Đang dựng lại..."):
+                    n = rebuild_report_cards()
+                st.success(f"Đã dựng lại bảng điểm cho {n} học sinh.")
+            st.caption("Chuyển user cũ sang khóa CCCD (đăng nhập nhanh, giữ nguyên điểm).")
+            if st.button("Migrate User"):
+                with st.spinner("Đang chuyển..."):
+                    moved, skipped = migrate_users_to_cccd_keys()
+                st.success(f"Đã chuyển {moved} user, bỏ qua {skipped}.")
 
     with tab2:
         st.subheader("Phân Quyền")
-        # Lấy tối đa 100 user để demo (Firebase load all có thể chậm nếu đông)
-        users_stream = db.collection('users').where('is_admin', '==', False).limit(100).stream()
+        f1, f2, f3 = st.columns(3)
+        filters = (f1.text_input("Mã HS").strip(), f2.text_input("Họ tên (bắt đầu bằng)").strip(), f3.text_input("Niên khóa").strip())
+        if st.session_state.get('um_filters') != filters:
+            # Đổi bộ lọc -> quay về trang đầu
+            st.session_state.um_filters = filters
+            st.session_state.um_cursors = [None]
+        cursors = st.session_state.um_cursors
+
+        try:
+            users, next_cursor = list_users_page(cursor=cursors[-1], ma_hs=filters[0], ho_ten=filters[1], nien_khoa=filters[2])
+        except Exception as e:
+            # Firestore chưa có composite index (firestore.indexes.json) -> lỗi FailedPrecondition kèm link tạo index
+            st.error(f"Không tải được danh sách user: {e}")
+            users, next_cursor = [], None
         data = []
-        for doc in users_stream:
-            u = doc.to_dict()
-            u['id'] = doc.id
+        for u in users:
             data.append({
-                "ID": u['id'], "Mã HS": u.get('ma_hs'), "Họ Tên": u.get('ho_ten'),
+                "ID": u['doc_id'], "Mã HS": u.get('ma_hs'), "Họ Tên": u.get('ho_ten'),
                 "Full Access": (u.get('login_status') == "full"),
                 "Số lần": u.get('login_status') if u.get('login_status') != "full" else "---",
                 "Reset Pass": False
             })
+
+        p1, p2, p3 = st.columns([1, 2, 1])
+        if p1.button("◀ Trang trước", disabled=len(cursors) == 1):
+            cursors.pop(); st.rerun()
+        p2.caption(f"Trang {len(cursors)} · {len(data)} user")
+        if p3.button("Trang sau ▶", disabled=next_cursor is None):
+            cursors.append(next_cursor); st.rerun()
         
         if data:
+            loaded_df = pd.DataFrame(data)
             edited_df = st.data_editor(
-                pd.DataFrame(data),
+                loaded_df,
                 column_config={
                     "ID": None,
                     "Full Access": st.column_config.CheckboxColumn("Không giới hạn?", default=False),
@@ -408,36 +1633,84 @@ def admin_ui():
                     "Số lần": st.column_config.TextColumn("Lượt còn lại", disabled=True)
                 },
                 disabled=["Mã HS", "Họ Tên"],
-                hide_index=True, use_container_width=True
+                hide_index=True, use_container_width=True,
+                key=f"um_editor_{len(cursors)}_{filters}"
             )
             
             if st.button("Lưu Thay Đổi"):
-                batch = db.batch()
-                c_up = 0
-                for idx, row in edited_df.iterrows():
-                    ref = db.collection('users').document(row['ID'])
-                    updates = {}
-                    
-                    # Logic Full
-                    if row['Full Access']: updates['login_status'] = 'full'
-                    else: updates['login_status'] = '5'
-                    
-                    # Logic Reset
-                    if row['Reset Pass']:
-                        updates['password_hash'] = generate_password_hash('123456')
-                    
-                    if updates:
-                        batch.update(ref, updates)
-                        c_up += 1
-                batch.commit()
+                # Chỉ ghi các dòng đã thay đổi so với dữ liệu vừa tải
+                c_up = save_user_changes(diff_user_changes(loaded_df, edited_df))
                 st.success(f"Đã cập nhật {c_up} user!")
                 st.rerun()
+        else: st.info("Không có user phù hợp.")
+
+    with tab3:
+        st.subheader("Xuất Bảng Điểm")
+        c1, c2, c3, c4 = st.columns(4)
+        nam_hoc = c1.text_input("Năm học", placeholder="2023-2024").strip()
+        hoc_ky = c2.selectbox("Học kỳ", ["HK1", "HK2", "CaNam"])
+        nien_khoa = c3.text_input("Niên khóa (trống = tất cả)").strip()
+        fmt = c4.selectbox("Định dạng", list(EXPORT_FORMATS), format_func=EXPORT_FORMATS.get)
+        if nam_hoc and st.button("Tạo file"):
+            try:
+                with st.spinner("Đang xuất..."):
+                    data, n = export_results(nam_hoc, hoc_ky, nien_khoa or None, fmt)
+                name = f"diem_{nam_hoc}_{hoc_ky}{'_' + nien_khoa if nien_khoa else ''}.{fmt}"
+                st.session_state.export_file = (name, data, n)
+            except Exception as e: st.error(f"Lỗi: {e}")
+        if st.session_state.get('export_file'):
+            name, data, n = st.session_state.export_file
+            st.caption(f"{name} · {n} học sinh")
+            st.download_button("⬇️ Tải về", data, file_name=name)
+
+    with tab4:
+        st.subheader("Thống Kê Theo Khối")
+        c1, c2, c3 = st.columns(3)
+        nam_hoc = c1.text_input("Năm học", placeholder="2023-2024", key="an_nam").strip()
+        hoc_ky = c2.selectbox("Học kỳ", ["HK1", "HK2", "CaNam"], key="an_hk")
+        khoi = c3.selectbox("Khối", [10, 11, 12], key="an_khoi")
+        if nam_hoc:
+            docs = [d for d in get_cohort_stats(nam_hoc, hoc_ky) if d.get('khoi') == khoi]
+            subjects = sorted((d for d in docs if d.get('kind') == 'scores'), key=lambda d: d['mon_hoc'])
+            if not docs: st.info("Chưa có thống kê (được tính khi upload điểm).")
+            if subjects:
+                st.dataframe(pd.DataFrame([{
+                    'Môn học': d['mon_hoc'], 'Số HS có điểm': d['n'], 'Điểm TB': d['mean'], 'Trung vị': d['median'],
+                    'Tỉ lệ đạt (%)': None if d['pass_rate'] is None else 100 * d['pass_rate'],
+                    'Đánh giá chữ': ', '.join(f"{k}: {v}" for k, v in (d.get('labels') or {}).items())
+                } for d in subjects]).round(2), hide_index=True, use_container_width=True)
+                mon = st.selectbox("Phân bố điểm", [d['mon_hoc'] for d in subjects])
+                hist = next(d['hist'] for d in subjects if d['mon_hoc'] == mon)
+                # 101 ô bước 0.1 -> 10 khoảng 1 điểm (điểm 10 vào khoảng cuối)
+                bins = np.add.reduceat(np.asarray(hist), np.arange(0, 100, 10))
+                st.bar_chart(pd.DataFrame({'Số HS': bins}, index=[f"{i}-{i + 1}" for i in range(10)]))
+            for d in docs:
+                if d.get('kind') != 'assessments': continue
+                a1, a2 = st.columns(2)
+                for col, field, title in ((a1, 'kq_hoc_tap', 'Học lực'), (a2, 'danh_hieu', 'Danh hiệu')):
+                    col.caption(title)
+                    col.dataframe(pd.Series((d.get('counts') or {}).get(field) or {}, name='Số HS', dtype=int), use_container_width=True)
+
+    with tab5:
+        st.subheader("Hiệu Năng Database")
+        if store.name != "firestore": st.caption("Chỉ đo các lệnh Firestore.")
+        by_op, by_scope = perf_tables()
+        if by_op.empty: st.info("Chưa có số liệu.")
+        else:
+            st.caption("Theo lệnh (các lần gọi gần nhất, nhiều lượt đọc / ghi nhất lên đầu)")
+            st.dataframe(by_op.round(1), hide_index=True, use_container_width=True)
+        if not by_scope.empty:
+            st.caption("Theo trang / job upload")
+            st.dataframe(by_scope.round(1), hide_index=True, use_container_width=True)
 
 # ==========================================
-# 6. MAIN
+# 8. MAIN
 # ==========================================
 def main():
     st.set_page_config(page_title="EduScore Pro", page_icon="🎓", layout="wide")
+    health = health_status()
+    if not health['ready']:
+        st.error(f"⚠️ Hệ thống chưa sẵn sàng: {health['error']}"); st.stop()
     if 'logged_in' not in st.session_state: st.session_state.logged_in = False
     if 'user_data' not in st.session_state: st.session_state.user_data = None
 
@@ -450,17 +1723,19 @@ def main():
                 p = st.text_input("Mật khẩu", type="password")
                 if st.form_submit_button("Đăng nhập", type="primary"):
                     user_data = get_user_by_cccd(u)
-                    if user_data and check_password_hash(user_data.get('password_hash'), p):
+                    if user_data and verify_password(user_data, p):
+                        # User cũ (hash của mật khẩu mặc định, chưa có cờ): đánh dấu để buộc đổi mật khẩu
+                        if not user_data.get('is_admin') and p == DEFAULT_PASSWORD:
+                            user_data['must_change_password'] = True
                         allow = False
                         if user_data.get('is_admin') or user_data.get('login_status') == "full": allow = True
                         else:
                             try:
-                                c = int(user_data.get('login_status'))
-                                if c > 0:
+                                # Trừ lượt (transaction, tránh 2 lần đăng nhập cùng lúc đọc cùng 1 giá trị)
+                                c = consume_login(user_data)
+                                if c is not None:
                                     allow = True
-                                    # Trừ lượt
-                                    db.collection('users').document(user_data['id']).update({'login_status': str(c-1)})
-                                    user_data['login_status'] = str(c-1) # Update local
+                                    user_data['login_status'] = str(c) # Update local
                                 else: st.error("🚫 Hết lượt truy cập!")
                             except: st.error("Lỗi tài khoản")
                         
@@ -473,5 +1748,10 @@ def main():
         if st.session_state.user_data.get('is_admin'): admin_ui()
         else: student_ui(st.session_state.user_data)
 
+def _page_name():
+    if not st.session_state.get('logged_in'): return "page:login"
+    return "page:admin" if (st.session_state.get('user_data') or {}).get('is_admin') else "page:student"
+
 if __name__ == "__main__":
-    main()
+    with perf_scope(_page_name()):
+        main()